@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the overhead of xyz itself.
+
+The benchmarks use synthetic package rules (see `SyntheticPackage`)
+with trivial configure and make steps, and install trees with a
+configurable number and size of files. This isolates the time spent
+in xyz (dependency handling, hashing, archiving, verifying) from the
+time spent in the build of any real package.
+
+Results are reported as the best time (in seconds) of a number of
+repeats, and can be written as JSON. When a baseline (a previous
+JSON result) is specified, each result is compared against it and
+any regression is reported.
+
+Usage:
+
+% ./bench.py --output results.json
+% ./bench.py --baseline results.json
+
+"""
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import sysconfig
+import tempfile
+import time
+
+import xyz
+import rules
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ice'))
+import ice
+
+# Create a module alias. This allows the synthetic rules to import
+# bench without creating a new module instance.
+sys.modules['bench'] = sys.modules[__name__]
+
+CONFIGURE_SCRIPT = """#!/bin/sh
+printf 'all:\\n\\t@true\\n' > Makefile
+"""
+
+RULE_TEMPLATE = """import bench
+
+class Rule(bench.SyntheticPackage):
+    pkg_name = {pkg_name!r}
+    deps = {deps!r}
+
+rules = Rule
+"""
+
+MODULE_TEMPLATE = '''"""Synthetic module {idx}."""
+import os
+
+
+def func_{idx}(a, b):
+    """Return something."""
+    return [x * a + b for x in range({idx})]
+
+
+class Class{idx}:
+    value = {idx!r}
+
+    def method(self):
+        return {{'idx': {idx}, 'name': __name__, 'path': os.sep}}
+'''
+
+
+class SyntheticPackage(xyz.Package):
+    """A package rule with trivial configure and make steps, that
+    installs a generated tree of `files` files of `file_size` bytes.
+
+    The source is cloned from a local git repository (`source_repo`).
+
+    """
+    source_repo = None
+    files = 1000
+    file_size = 4096
+
+    def __init__(self, builder, variant):
+        super().__init__(builder, variant)
+        self.config['repo_name'] = self.source_repo
+
+    @property
+    def full_deps(self):
+        return self.deps
+
+    def configure(self):
+        self.cmd('{source_dir_from_build}/configure')
+
+    def install(self):
+        generate_tree(self.j('{eprefix_dir}', 'lib', '{pkg_name}'), self.pkg_name, self.files, self.file_size)
+
+
+def generate_tree(root, seed, files, file_size):
+    """Generate a directory tree in `root` with `files` files, each of
+    `file_size` bytes. The contents are deterministic for a given `seed`.
+
+    """
+    rng = random.Random(seed)
+    for i in range(files):
+        d = os.path.join(root, 'd{:03d}'.format(i // 100))
+        if i % 100 == 0:
+            xyz.ensure_dir(d)
+        with open(os.path.join(d, 'f{:05d}'.format(i)), 'wb') as f:
+            f.write(rng.getrandbits(8 * file_size).to_bytes(file_size, 'little'))
+
+
+def create_source_repo(path):
+    """Create a git repository containing the synthetic configure script."""
+    xyz.ensure_dir(path)
+    with xyz.chdir(path):
+        configure = 'configure'
+        with open(configure, 'w') as f:
+            f.write(CONFIGURE_SCRIPT)
+        os.chmod(configure, 0o755)
+        for cmd in (['git', 'init', '-q'],
+                    ['git', 'add', configure],
+                    ['git', '-c', 'user.name=xyz', '-c', 'user.email=xyz@localhost',
+                     'commit', '-q', '-m', 'Synthetic source']):
+            subprocess.check_call(cmd)
+
+
+def create_rules(rules_dir, count):
+    """Create `count` synthetic rules modules in `rules_dir`.
+
+    Each package depends on the previous two packages, giving a DAG
+    where many packages are reached through multiple paths. Returns
+    the name of the final package.
+
+    """
+    xyz.ensure_dir(rules_dir)
+    for i in range(count):
+        deps = ['bench{}'.format(j) for j in (i - 2, i - 1) if j >= 0]
+        with open(os.path.join(rules_dir, 'bench{}.py'.format(i)), 'w') as f:
+            f.write(RULE_TEMPLATE.format(pkg_name='bench{}'.format(i), deps=deps))
+    return 'bench{}'.format(count - 1)
+
+
+def create_modules(lib_dir, count):
+    """Create `count` synthetic Python modules, in packages of 50 modules."""
+    for i in range(count):
+        pkg_dir = os.path.join(lib_dir, 'pkg{}'.format(i // 50))
+        if i % 50 == 0:
+            xyz.ensure_dir(pkg_dir)
+            with open(os.path.join(pkg_dir, '__init__.py'), 'w') as f:
+                f.write(MODULE_TEMPLATE.format(idx=i))
+        with open(os.path.join(pkg_dir, 'mod{}.py'.format(i)), 'w') as f:
+            f.write(MODULE_TEMPLATE.format(idx=i))
+
+
+def create_main(lib_dir, count):
+    """Create a main module, in `lib_dir`, that imports the `count`
+    synthetic modules (see `create_modules`).
+
+    """
+    with open(os.path.join(lib_dir, 'main.py'), 'w') as f:
+        for i in range(count):
+            f.write('import pkg{}.mod{}\n'.format(i // 50, i))
+
+
+def compile_app(output, sources):
+    """Compile and link a frozen app with the compiler and flags used to
+    build the running Python. Returns False if the app can't be built
+    (e.g.: the Python library or headers aren't available).
+
+    """
+    config = sysconfig.get_config_var
+    libdir = config('LIBDIR')
+    cmd = (config('CC') or 'cc').split() + ['-O2', '-w', '-I', sysconfig.get_paths()['include'], '-o', output]
+    cmd += sources
+    cmd += ['-L', libdir, '-Wl,-rpath,' + libdir, '-lpython' + config('LDVERSION')]
+    cmd += (config('LIBS') or '').split() + (config('SYSLIBS') or '').split() + ['-lz']
+    try:
+        subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+    except OSError as e:
+        xyz.logger.warning("Unable to compile frozen app: %s", e)
+        return False
+    except subprocess.CalledProcessError as e:
+        xyz.logger.warning("Unable to compile frozen app:\n%s", e.output.decode(errors='replace'))
+        return False
+    return True
+
+
+def timed(fn, repeat=1, setup=None):
+    """Return the best time of `repeat` calls of `fn`.
+
+    If specified, `setup` is called (untimed) before each call of `fn`.
+
+    """
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        t = time.perf_counter() - start
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def quiet(fn):
+    """Return a function that calls `fn` with stdout discarded."""
+    def helper():
+        stdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            fn()
+        finally:
+            sys.stdout = stdout
+    return helper
+
+
+def run_benchmarks(args, work_dir):
+    results = {}
+
+    def bench(name, fn, repeat=args.repeat, setup=None):
+        results[name] = timed(fn, repeat, setup)
+        xyz.logger.warning("%-28s %10.4fs", name, results[name])
+
+    SyntheticPackage.source_repo = os.path.join(work_dir, 'repo')
+    SyntheticPackage.files = args.files
+    SyntheticPackage.file_size = args.file_size
+    create_source_repo(SyntheticPackage.source_repo)
+    rules_dir = os.path.join(work_dir, 'rules')
+    rules.__path__.append(rules_dir)
+    top = create_rules(rules_dir, args.packages)
+
+    packaging_dir = os.path.join(work_dir, 'packaging')
+    xyz.ensure_dir(packaging_dir)
+    with xyz.chdir(packaging_dir):
+        def clean():
+            xyz.clean_release()
+            # Forget any cached packages (and their build keys).
+            builder.packages = {}
+
+        builder = xyz.Builder()
+        bench('build_dag', lambda: builder.build(top), repeat=1, setup=clean)
+        builder.packages = {}
+        bench('build_dag_deps_present', lambda: builder.build(top))
+
+        pkg = builder._load_pkg(top, {})
+        tree = pkg.j('{prefix_dir}')
+        bench('package_listing', lambda: list(xyz.listing_entries(tree)))
+        tar_file = os.path.join(work_dir, 'bench.tar.gz')
+        bench('package_tar_gz', lambda: xyz.tar_gz(tar_file, tree))
+
+        bench('check_releases', quiet(xyz.check_releases))
+        index_file = os.path.join('release', xyz.ReleaseIndex.filename)
+        os.rename(index_file, index_file + '.bench')
+        bench('check_releases_no_index', quiet(xyz.check_releases))
+        os.rename(index_file + '.bench', index_file)
+
+    pkg_root = os.path.join(work_dir, 'pkg_root')
+    xyz.ensure_dir(pkg_root)
+    release_dir = os.path.join(packaging_dir, 'release')
+    for f in os.listdir(release_dir):
+        if f.endswith('.tar.gz'):
+            subprocess.check_call(['tar', 'xf', os.path.join(release_dir, f), '-C', pkg_root])
+    bench('pkgroot_construct', lambda: xyz.PkgRoot(pkg_root))
+    pr = xyz.PkgRoot(pkg_root)
+    bench('pkgroot_verify', quiet(pr.verify))
+    bench('pkgroot_verify_quick', quiet(lambda: pr.verify(quick=True)))
+
+    lib_dir = os.path.join(work_dir, 'pylib')
+    create_modules(lib_dir, args.modules)
+    ice_dir = os.path.join(work_dir, 'ice')
+    xyz.ensure_dir(ice_dir)
+    with xyz.chdir(ice_dir):
+        mods = ice.find_modules(lib_dir)
+        bench('ice_create_frozen_lib', lambda: ice.create_frozen_lib('bench', mods))
+
+        # Compare the startup time (importing all the synthetic
+        # modules) of apps using the standard (linear) frozen module
+        # lookup, and the hash index.
+        create_main(lib_dir, args.modules)
+        ice.create_stdlib(encoding='incbin', jobs=args.jobs, cache_dir=os.path.join(work_dir, 'ice_cache'))
+        ice.create_lib('bench', lib_dir, main='main', encoding='incbin', jobs=args.jobs)
+        for name, index in (('linear', False), ('indexed', True)):
+            app = os.path.abspath('app_{}'.format(name))
+            ice.create_app(['stdlib', 'bench'], 'main_{}.c'.format(name), index=index)
+            if not compile_app(app, ['main_{}.c'.format(name), 'stdlib.S', 'bench.S']):
+                xyz.logger.warning("Skipping app startup benchmarks")
+                break
+            bench('app_startup_{}'.format(name),
+                  lambda: subprocess.check_call([app], stdout=subprocess.DEVNULL))
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print a comparison of `results` against `baseline`. Returns the
+    list of benchmarks that are slower than the baseline by more than
+    `threshold` (a ratio).
+
+    """
+    regressions = []
+    print('{:28s} {:>10s} {:>10s} {:>7s}'.format('benchmark', 'time', 'baseline', 'ratio'))
+    for name, t in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            print('{:28s} {:10.4f} {:>10s}'.format(name, t, '-'))
+            continue
+        ratio = t / base if base else float('inf')
+        flag = ''
+        if ratio > threshold:
+            flag = ' REGRESSION'
+            regressions.append(name)
+        print('{:28s} {:10.4f} {:10.4f} {:7.2f}{}'.format(name, t, base, ratio, flag))
+    return regressions
+
+
+def main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='XYZ benchmarks.')
+    parser.add_argument('--packages', type=int, default=8, help='Number of synthetic packages. (default: 8)')
+    parser.add_argument('--files', type=int, default=1000, help='Files per package. (default: 1000)')
+    parser.add_argument('--file-size', type=int, default=4096, help='Size of each file. (default: 4096)')
+    parser.add_argument('--modules', type=int, default=500, help='Number of modules to freeze. (default: 500)')
+    parser.add_argument('-j', dest='jobs', type=int, default=1,
+                        help='Processes used to compile frozen modules. (default: 1)')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of repeats for each benchmark. (default: 3)')
+    parser.add_argument('--output', help='Write results to a JSON file.')
+    parser.add_argument('--baseline', help='Compare results against a baseline JSON file.')
+    parser.add_argument('--threshold', type=float, default=1.10,
+                        help='Ratio above which a result is a regression. (default: 1.10)')
+    parser.add_argument('--keep', action='store_true', default=False,
+                        help='Keep the working directory.')
+    args = parser.parse_args(argv[1:])
+
+    xyz.logger.setLevel('WARNING')
+    work_dir = tempfile.mkdtemp(prefix='xyz-bench-')
+    try:
+        results = run_benchmarks(args, work_dir)
+    finally:
+        if args.keep:
+            print("Working directory: {}".format(work_dir))
+        else:
+            shutil.rmtree(work_dir)
+
+    output = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': sys.platform,
+            'xyz_version': xyz.xyz_version(),
+            'packages': args.packages,
+            'files': args.files,
+            'file_size': args.file_size,
+            'modules': args.modules,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=4, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['meta'] != dict(output['meta'], xyz_version=baseline['meta']['xyz_version'],
+                                    python=baseline['meta']['python']):
+            print("warning: baseline parameters differ: {}".format(baseline['meta']))
+        if compare(results, baseline['results'], args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
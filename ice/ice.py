@@ -18,6 +18,10 @@ solution in other use-cases. The standard library, is relatively
 large, so if you don't use much of it, and don't need plugins, then
 this is probably not for you (try cxFreeze).
 
+Alternatively, the standard library can be pruned to the modules that
+are statically reachable (by import) from an entry module, plus an
+explicit list of packages that plugins may use (see `prune_modules`).
+
 
 Additional motivations:
 
@@ -45,6 +49,38 @@ and extern definitions of the library. These header files are
 used when creating an app, but can be included in a C file directly
 if you know what you are doing.
 
+The byte code can be written in a number of encodings (see
+ENCODINGS). The default is a decimal initializer list. A hex
+initializer list, or a string literal (which is smaller and faster
+for the compiler to parse) can also be used. Finally, the 'incbin'
+encoding writes the byte code to a binary blob, and a <library_name>.S
+assembler file that includes it (with the .incbin directive), rather
+than a C file. This avoids the C compiler parsing the byte code at
+all.
+
+Large libraries (such as the standard library) can be split in to a
+number of shards, each in its own C file, so that they can be compiled
+in parallel (e.g.: with make -j). Compiled modules can also be cached
+(keyed by the module source, Python version and optimisation level),
+so regenerating a library only compiles the modules that changed, and
+only the shards that contain changed modules are rewritten.
+
+A library can also be compressed. The compressed modules are stored
+zlib compressed in a single blob (<library_name>_z.c), described by
+<library_name>_zstruct.h. An app created from a compressed library
+includes a small builtin module (_xyz_frozen) and an import hook that
+decompresses each module only when it is first imported, so the
+cost of decompression is only paid for the modules that are used.
+Modules needed while the interpreter is initialised are never
+compressed. Apps using compressed libraries must be linked with zlib.
+
+An app can also be created with an import profiler, which reports the
+time taken to initialise the interpreter, and the time (and byte code
+size) of each import, in the same style as `python -X importtime`.
+The report for the same entry point run with the filesystem standard
+library can be compared with `ice.py profile` (see `compare_profiles`),
+to find the modules worth pruning or compressing.
+
 
 Usage:
 
@@ -70,6 +106,13 @@ see the specific rules and Setup.dist files:
 https://github.com/BreakawayConsulting/xyz/blob/master/rules/python.py
 https://github.com/BreakawayConsulting/xyz/blob/master/rules/pySetup.dist.darwin
 
+Extension modules listed in the static sections of Modules/Setup can
+be added to the app's built in modules table (`create_app` with
+`static_extensions`), so they are never searched for on the
+filesystem. Shared extension modules (in lib-dynload) can't be frozen,
+and are reported when creating the frozen standard library; they must
+be moved to the *static* section of Modules/Setup to be part of an app.
+
 Drawbacks:
 
 This current version does not really have any explicit support for
@@ -87,16 +130,30 @@ own build system.
 This has only been tested with my use-cases so your milage may vary!
 
 """
+import ast
+import hashlib
+import io
 import marshal
+import multiprocessing
 import os
 import re
+import subprocess
 import sys
+import sysconfig
 import tokenize
+import zlib
 
 STDLIB_EXCLUDE_LIST = ['test', 'tkinter', 'turtledemo',
                        'tkinter', 'lib2to3', 'idlelib',
                        'distutils']
 
+# Modules that are imported while the interpreter is initialised, so
+# must always be frozen (along with the modules they import).
+STDLIB_BOOTSTRAP_LIST = ['importlib._bootstrap', 'importlib._bootstrap_external',
+                         'encodings', 'encodings.aliases', 'encodings.ascii',
+                         'encodings.latin_1', 'encodings.utf_8',
+                         'io', 'site', 'zipimport']
+
 SUFFIX = '.py'
 
 HEADER = """/* Generated by freeze.py */
@@ -126,7 +183,11 @@ main(int argc, char *argv[])
     setlocale(LC_ALL, "");
     for (i = 0; i < argc; i++)
     {
+#if PY_VERSION_HEX >= 0x03050000
+        argv_copy[i] = Py_DecodeLocale(argv[i], NULL);
+#else
         argv_copy[i] = _Py_char2wchar(argv[i], NULL);
+#endif
         if (!argv_copy[i])
         {
             free(oldloc);
@@ -144,10 +205,14 @@ main(int argc, char *argv[])
 
     Py_FrozenFlag = 1; /* suppress errors from getpath.c */
 
+    xyz_pre_init();
     Py_Initialize();
     PySys_SetArgvEx(argc, argv_copy, 0);
 
-    n = PyImport_ImportFrozenModule("__main__");
+    if (xyz_post_init() < 0)
+        n = -1;
+    else
+        n = PyImport_ImportFrozenModule("__main__");
 
     if (n < 0)
     {
@@ -157,7 +222,11 @@ main(int argc, char *argv[])
 
     Py_Finalize();
     for (i = 0; i < argc; i++) {
+#if PY_VERSION_HEX >= 0x03050000
+        PyMem_RawFree(argv_copy2[i]);
+#else
         PyMem_Free(argv_copy2[i]);
+#endif
     }
     PyMem_Free(argv_copy);
     PyMem_Free(argv_copy2);
@@ -175,9 +244,447 @@ ARRAY_TRAILER = """\
     {0, 0, 0} /* sentinel */
 };
 
+#if PY_VERSION_HEX >= 0x03040000
+const struct _frozen *PyImport_FrozenModules = _PyImport_FrozenModules;
+#else
 struct _frozen *PyImport_FrozenModules = _PyImport_FrozenModules;
+#endif
+"""
+
+
+RUN_SOURCE_FN = """
+/* Run Python source in its own namespace, to avoid polluting __main__. */
+static int
+xyz_run_source(const char *name, const char *src)
+{
+    PyObject *d, *n = NULL, *r;
+
+    d = PyDict_New();
+    if (d == NULL)
+        goto error;
+    n = PyUnicode_FromString(name);
+    if (n == NULL)
+        goto error;
+    if (PyDict_SetItemString(d, "__builtins__", PyEval_GetBuiltins()) < 0 ||
+        PyDict_SetItemString(d, "__name__", n) < 0)
+        goto error;
+    Py_CLEAR(n);
+    r = PyRun_String(src, Py_file_input, d, d);
+    if (r == NULL)
+        goto error;
+    Py_DECREF(r);
+    Py_DECREF(d);
+    return 0;
+
+error:
+    Py_XDECREF(n);
+    Py_XDECREF(d);
+    PyErr_Print();
+    return -1;
+}
+"""
+
+# The profiled app records the time to initialise the interpreter,
+# which is passed to the profiler as sys._xyz_init_time.
+PROFILE_FN = """
+#include <sys/time.h>
+
+static double xyz_init_start;
+
+static double
+xyz_time(void)
+{
+    struct timeval tv;
+
+    gettimeofday(&tv, NULL);
+    return tv.tv_sec + tv.tv_usec / 1e6;
+}
+
+static int
+xyz_set_init_time(void)
+{
+    PyObject *t = PyFloat_FromDouble(xyz_time() - xyz_init_start);
+
+    if (t == NULL || PySys_SetObject("_xyz_init_time", t) < 0)
+    {
+        Py_XDECREF(t);
+        PyErr_Print();
+        return -1;
+    }
+    Py_DECREF(t);
+    return 0;
+}
+"""
+
+# Import profiler, similar to `python -X importtime`. Each module load
+# is reported (when complete) with its self and cumulative time, and
+# the size of its (marshalled and compressed) byte code from SIZES,
+# which is prepended to this source. The report is written to the
+# file named by XYZ_IMPORT_PROFILE, or stderr.
+#
+# This is also used to profile a Python file with the filesystem
+# standard library (see `profile_filesystem`).
+PROFILE_SRC = """\
+import os
+import sys
+import time
+
+def install():
+    bootstrap = sys.modules['_frozen_importlib']
+    find_and_load = bootstrap._find_and_load
+    filename = os.environ.get('XYZ_IMPORT_PROFILE')
+    out = open(filename, 'w') if filename else sys.stderr
+    stack = []
+
+    def write(line):
+        out.write('import time: ' + line + '\\n')
+        out.flush()
+
+    init_time = sys.__dict__.pop('_xyz_init_time', None)
+    if init_time is not None:
+        write('init [us]: {}'.format(int(init_time * 1e6)))
+    write('{:>10} | {:>10} | {:>10} | {:>10} | {}'.format('self [us]', 'cumulative', 'size', 'compressed',
+                                                            'imported package'))
+
+    def profiled_find_and_load(name, *args):
+        stack.append(0)
+        start = time.perf_counter()
+        try:
+            return find_and_load(name, *args)
+        finally:
+            cumulative = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += cumulative
+            size, csize = SIZES.get(name, ('-', '-'))
+            write('{:10d} | {:10d} | {:>10} | {:>10} | {}{}'.format(
+                int((cumulative - children) * 1e6), int(cumulative * 1e6), size, csize or '-',
+                '  ' * len(stack), name))
+
+    bootstrap._find_and_load = profiled_find_and_load
+
+install()
 """
 
+INITTAB_HEADER = """
+static struct _inittab _xyz_inittab[] = {
+"""
+
+INITTAB_TRAILER = """\
+    {0, 0} /* sentinel */
+};
+"""
+
+INIT_FMT = """
+static void
+xyz_pre_init(void)
+{{
+{pre_init}}}
+
+static int
+xyz_post_init(void)
+{{
+{post_init}    return 0;
+}}
+"""
+
+# The _xyz_frozen builtin module provides (indexed and/or compressed)
+# access to frozen modules. The module table is generated from each
+# library's _struct.h and _zstruct.h files. An entry with a csize of
+# zero is not compressed.
+FROZEN_MODULE_HEADER = """
+#include <marshal.h>
+#ifdef XYZ_FROZEN_COMPRESSED
+#include <zlib.h>
+#endif
+
+struct _xyz_frozen {
+    const char *name;
+    const unsigned char *blob;
+    unsigned int offset;
+    unsigned int csize;
+    unsigned int usize;
+    int is_pkg;
+};
+
+static struct _xyz_frozen _xyz_frozen_modules[] = {
+"""
+
+FROZEN_MODULE_TRAILER = """\
+    {0, 0, 0, 0, 0, 0} /* sentinel */
+};
+"""
+
+# The index is an open addressing hash table (with linear probing) of
+# indexes in to _xyz_frozen_modules. The hash is 32-bit FNV-1a; see
+# `name_hash`.
+FROZEN_INDEX_HEADER = """
+#define XYZ_FROZEN_INDEX_MASK {mask}U
+
+static const int _xyz_frozen_index[] = {{
+"""
+
+FROZEN_INDEX_TRAILER = """\
+};
+"""
+
+FROZEN_MODULE_FUNCS = """
+static struct _xyz_frozen *
+xyz_frozen_find(const char *name)
+{
+#ifdef XYZ_FROZEN_INDEX_MASK
+    unsigned int h = 2166136261U;
+    const unsigned char *c;
+    int i;
+
+    for (c = (const unsigned char *)name; *c != 0; c++)
+        h = (h ^ *c) * 16777619U;
+    for (h &= XYZ_FROZEN_INDEX_MASK; (i = _xyz_frozen_index[h]) >= 0; h = (h + 1) & XYZ_FROZEN_INDEX_MASK)
+    {
+        if (strcmp(_xyz_frozen_modules[i].name, name) == 0)
+            return &_xyz_frozen_modules[i];
+    }
+#else
+    struct _xyz_frozen *p;
+
+    for (p = _xyz_frozen_modules; p->name != NULL; p++)
+    {
+        if (strcmp(p->name, name) == 0)
+            return p;
+    }
+#endif
+    return NULL;
+}
+
+static PyObject *
+xyz_frozen_is_package(PyObject *self, PyObject *args)
+{
+    const char *name;
+    struct _xyz_frozen *p;
+
+    if (!PyArg_ParseTuple(args, "s", &name))
+        return NULL;
+    p = xyz_frozen_find(name);
+    if (p == NULL)
+        Py_RETURN_NONE;
+    return PyBool_FromLong(p->is_pkg);
+}
+
+static PyObject *
+xyz_frozen_get_code(PyObject *self, PyObject *args)
+{
+    const char *name;
+    struct _xyz_frozen *p;
+
+    if (!PyArg_ParseTuple(args, "s", &name))
+        return NULL;
+    p = xyz_frozen_find(name);
+    if (p == NULL)
+    {
+        PyErr_Format(PyExc_ImportError, "No such frozen object named %s", name);
+        return NULL;
+    }
+    if (p->csize == 0)
+        return PyMarshal_ReadObjectFromString((char *)p->blob + p->offset, p->usize);
+#ifdef XYZ_FROZEN_COMPRESSED
+    {
+        unsigned char *buf;
+        uLongf len;
+        PyObject *code;
+
+        buf = (unsigned char *)PyMem_Malloc(p->usize);
+        if (buf == NULL)
+            return PyErr_NoMemory();
+        len = p->usize;
+        if (uncompress(buf, &len, p->blob + p->offset, p->csize) != Z_OK || len != p->usize)
+        {
+            PyMem_Free(buf);
+            PyErr_Format(PyExc_ImportError, "Can't decompress frozen object named %s", name);
+            return NULL;
+        }
+        code = PyMarshal_ReadObjectFromString((char *)buf, len);
+        PyMem_Free(buf);
+        return code;
+    }
+#else
+    PyErr_Format(PyExc_ImportError, "Can't decompress frozen object named %s", name);
+    return NULL;
+#endif
+}
+
+static PyMethodDef xyz_frozen_methods[] = {
+    {"is_package", xyz_frozen_is_package, METH_VARARGS, NULL},
+    {"get_code", xyz_frozen_get_code, METH_VARARGS, NULL},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef xyz_frozen_module = {
+    PyModuleDef_HEAD_INIT, "_xyz_frozen", NULL, -1, xyz_frozen_methods
+};
+
+static PyObject *
+PyInit__xyz_frozen(void)
+{
+    PyObject *m = PyModule_Create(&xyz_frozen_module);
+#ifdef XYZ_FROZEN_INDEX_MASK
+    if (m != NULL && PyModule_AddIntConstant(m, "indexed", 1) < 0)
+#else
+    if (m != NULL && PyModule_AddIntConstant(m, "indexed", 0) < 0)
+#endif
+    {
+        Py_DECREF(m);
+        return NULL;
+    }
+    return m;
+}
+"""
+
+# Importer for the modules in _xyz_frozen. This supports both the
+# find_spec (Python 3.4+) and find_module (Python 3.3) protocols.
+#
+# When the modules are indexed, every frozen module is in the index,
+# so the standard FrozenImporter (which linearly searches the frozen
+# modules table) is replaced.
+FROZEN_IMPORTER = """\
+import sys
+import _xyz_frozen
+
+class XyzFrozenImporter:
+    @classmethod
+    def find_spec(cls, fullname, path=None, target=None):
+        is_pkg = _xyz_frozen.is_package(fullname)
+        if is_pkg is None:
+            return None
+        bootstrap = sys.modules['_frozen_importlib']
+        return bootstrap.ModuleSpec(fullname, cls, origin='frozen', is_package=is_pkg)
+
+    @classmethod
+    def find_module(cls, fullname, path=None):
+        if _xyz_frozen.is_package(fullname) is None:
+            return None
+        return cls
+
+    @classmethod
+    def create_module(cls, spec):
+        return None
+
+    @classmethod
+    def exec_module(cls, module):
+        exec(_xyz_frozen.get_code(module.__name__), module.__dict__)
+
+    @classmethod
+    def load_module(cls, fullname):
+        code = _xyz_frozen.get_code(fullname)
+        module = sys.modules.get(fullname)
+        if module is None:
+            module = sys.modules[fullname] = type(sys)(fullname)
+        module.__loader__ = cls
+        if _xyz_frozen.is_package(fullname):
+            module.__path__ = [fullname]
+            module.__package__ = fullname
+        else:
+            module.__package__ = fullname.rpartition('.')[0]
+        try:
+            exec(code, module.__dict__)
+        except:
+            del sys.modules[fullname]
+            raise
+        return sys.modules[fullname]
+
+    @classmethod
+    def get_code(cls, fullname):
+        return _xyz_frozen.get_code(fullname)
+
+    @classmethod
+    def get_source(cls, fullname):
+        return None
+
+    @classmethod
+    def is_package(cls, fullname):
+        return bool(_xyz_frozen.is_package(fullname))
+
+if _xyz_frozen.indexed:
+    frozen_importer = sys.modules['_frozen_importlib'].FrozenImporter
+    sys.meta_path[:] = [i for i in sys.meta_path if i is not frozen_importer]
+sys.meta_path.insert(0, XyzFrozenImporter)
+"""
+
+STRUCT_RE = re.compile(r'\s*\{"([^"]*)", (\w+), (-?\d+)\},$')
+ZSTRUCT_RE = re.compile(r'\s*\{"([^"]*)", (\w+), (\d+), (\d+), (\d+), (\d+)\},$')
+ZSTRUCT_FMT = '    {{"{}", {}, {}, {}, {}, {}}},\n'
+
+
+def name_hash(name):
+    """Return the 32-bit FNV-1a hash of a module name. This must match
+    xyz_frozen_find in FROZEN_MODULE_FUNCS.
+
+    """
+    h = 2166136261
+    for c in name.encode():
+        h = ((h ^ c) * 16777619) & 0xffffffff
+    return h
+
+
+def build_index(names):
+    """Build an open addressing hash table for `names`.
+
+    Returns a list (with a power of two length, at most half full),
+    where each slot contains either the position of a name in `names`,
+    or -1 for an empty slot. If a name appears more than once only the
+    first occurrence is indexed.
+
+    """
+    size = 2
+    while size < 2 * len(names):
+        size *= 2
+    mask = size - 1
+    table = [-1] * size
+    seen = set()
+    for i, name in enumerate(names):
+        if name in seen:
+            continue
+        seen.add(name)
+        h = name_hash(name) & mask
+        while table[h] != -1:
+            h = (h + 1) & mask
+        table[h] = i
+    return table
+
+
+def read_structs(lib, uncompressed=True):
+    """Return the modules entries of the frozen library `lib` as
+    (name, blob, offset, csize, usize, is_pkg) tuples.
+
+    This reads both the `{lib}_struct.h` (unless `uncompressed` is
+    False) and (if it exists) `{lib}_zstruct.h` files.
+
+    """
+    entries = []
+    if uncompressed:
+        with open('{}_struct.h'.format(lib)) as f:
+            for line in f:
+                m = STRUCT_RE.match(line)
+                if m is None:
+                    raise Exception("Unexpected line in {}_struct.h: {}".format(lib, line.rstrip()))
+                name, var_name, size = m.group(1), m.group(2), int(m.group(3))
+                entries.append((name, var_name, 0, 0, abs(size), int(size < 0)))
+    zstruct_filename = '{}_zstruct.h'.format(lib)
+    if os.path.exists(zstruct_filename):
+        with open(zstruct_filename) as f:
+            for line in f:
+                m = ZSTRUCT_RE.match(line)
+                if m is None:
+                    raise Exception("Unexpected line in {}: {}".format(zstruct_filename, line.rstrip()))
+                entries.append((m.group(1), m.group(2)) + tuple(int(g) for g in m.groups()[2:]))
+    return entries
+
+
+def c_string(text):
+    """Return `text` as a C string literal (split over multiple lines)."""
+    lines = text.splitlines(True)
+    escaped = [l.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for l in lines]
+    return '\n'.join('    "{}"'.format(l) for l in escaped)
+
 
 def dict_inverse(dct, exact=False):
     """Given an input dictionary (`dct`), create a new dictionary
@@ -216,18 +723,222 @@ def dict_inverse(dct, exact=False):
     return r
 
 
-def write_byte_code(outf, var_name, byte_code):
-    """Write out `byte_code` as variable `var_name` to a file-like object `outf`."""
+# Byte code can be written out as a C array in a number of different
+# encodings:
+#
+#   dec: Decimal initializer list (the original format).
+#   hex: Dense hexadecimal initializer list.
+#   string: Escaped string literal.
+#   incbin: The byte code is written to a binary blob which is included
+#     by an assembler (.S) file with the `.incbin` directive. This avoids
+#     the C compiler parsing huge initializer lists entirely.
+ENCODINGS = ['dec', 'hex', 'string', 'incbin']
+
+# The text for each byte value, for each of the C encodings.
+_BYTE_TEXT = {
+    'dec': ['%d,' % c for c in range(256)],
+    'hex': ['0x%02x,' % c for c in range(256)],
+    # Printable characters are used directly, except for the escape
+    # character, the quote, and '?' (to avoid trigraphs). Other bytes use
+    # a 3 digit octal escape, which can't consume any following digits.
+    'string': [chr(c) if 32 <= c < 127 and chr(c) not in '\\"?' else '\\%03o' % c
+               for c in range(256)],
+}
+
+# Bytes per line for each of the C encodings.
+_LINE_BYTES = {'dec': 16, 'hex': 32, 'string': 64}
+
+INCBIN_HEADER = """/* Generated by freeze.py */
+#ifdef __APPLE__
+#define SYM(x) _##x
+    .const
+#else
+#define SYM(x) x
+    .section .note.GNU-stack,"",@progbits
+    .section .rodata
+#endif
+"""
+
+INCBIN_FMT = """
+    .globl SYM({var_name})
+SYM({var_name}):
+    .incbin "{blob_name}", {offset}, {size}
+"""
+
+
+def write_byte_code(outf, var_name, byte_code, encoding='dec'):
+    """Write out `byte_code` as variable `var_name` to a file-like object `outf`.
+
+    `encoding` is one of 'dec', 'hex' or 'string' (see ENCODINGS).
+
+    """
+    byte_code = bytes(byte_code)
+    text = _BYTE_TEXT[encoding].__getitem__
+    n = _LINE_BYTES[encoding]
+    lines = [''.join(map(text, byte_code[i:i + n])) for i in range(0, len(byte_code), n)]
+    if encoding == 'string':
+        outf.write('unsigned char {}[{}] ='.format(var_name, len(byte_code)))
+        outf.write(''.join('\n    "{}"'.format(l) for l in lines))
+        outf.write(';\n')
+    else:
+        outf.write('unsigned char {}[] = {{'.format(var_name))
+        outf.write(''.join('\n    ' + l for l in lines))
+        outf.write('\n};\n')
+
+
+def write_incbin(outf, var_name, blob_name, offset, size):
+    """Write out an assembler definition of variable `var_name` to a
+    file-like object `outf`. The variable's contents are `size` bytes at
+    `offset` in the binary file `blob_name`.
+
+    The output file should start with INCBIN_HEADER.
+
+    """
+    outf.write(INCBIN_FMT.format(var_name=var_name, blob_name=blob_name, offset=offset, size=size))
+
+
+# Optimisation level used when compiling modules.
+OPTIMIZE = 2
 
-    outf.write('unsigned char {}[] = {{'.format(var_name))
-    for i in range(0, len(byte_code), 16):
-        outf.write('\n    ')
-        for c in bytes(byte_code[i:i + 16]):
-            outf.write('%d,' % c)
-    outf.write('\n};\n')
 
+def compile_module(mod):
+    """Compile a module, and return the marshalled code object.
 
-def create_frozen_lib(name, mods, aliases={}):
+    `mod` is a module description (filename, short_filename, is_pkg)
+    triple, as returned by `find_modules`.
+
+    """
+    (filename, short_filename, is_pkg) = mod
+    with tokenize.open(filename) as f:
+        code = compile(f.read(), short_filename, 'exec', optimize=OPTIMIZE)
+    return marshal.dumps(code)
+
+
+def format_module(job):
+    """Format the byte code of a module as C.
+
+    `job` is a (var_name, raw_code, encoding) triple. Returns the C text.
+
+    """
+    (var_name, raw_code, encoding) = job
+    outf = io.StringIO()
+    write_byte_code(outf, var_name, raw_code, encoding)
+    return outf.getvalue()
+
+
+def pool_map(fn, items, processes=1):
+    """Generate `fn(item)` for each of the `items` (in order).
+
+    When `processes` is greater than one `fn` is run by a pool of
+    processes. The results are still generated in order.
+
+    """
+    if processes <= 1 or len(items) <= 1:
+        for item in items:
+            yield fn(item)
+        return
+
+    with multiprocessing.Pool(processes) as pool:
+        for result in pool.imap(fn, items, 8):
+            yield result
+
+
+def module_cache_key(mod):
+    """Return the key used to cache the compiled code of module `mod`.
+
+    The key is a hash of the module source, the module's short
+    filename (which is embedded in the code), the Python version and
+    the optimisation level.
+
+    """
+    (filename, short_filename, is_pkg) = mod
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        h.update(f.read())
+    h.update('{}\n{}\n{}'.format(short_filename, sys.version, OPTIMIZE).encode())
+    return h.hexdigest()
+
+
+def compile_modules(mods, names, processes=1, cache_dir=None):
+    """Compile the modules `names` from the `mods` dictionary of module
+    descriptions. Return a dictionary of marshalled code indexed by
+    module name.
+
+    When `cache_dir` is specified the compiled code for each module is
+    cached in that directory, and only modules that are not already in
+    the cache are compiled.
+
+    """
+    codes = {}
+    keys = {}
+    todo = []
+    for mod_name in names:
+        if cache_dir is not None:
+            keys[mod_name] = module_cache_key(mods[mod_name])
+            cache_file = os.path.join(cache_dir, keys[mod_name])
+            if os.path.exists(cache_file):
+                with open(cache_file, 'rb') as f:
+                    codes[mod_name] = f.read()
+                continue
+        todo.append(mod_name)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    results = pool_map(compile_module, [mods[mod_name] for mod_name in todo], processes)
+    for mod_name, raw_code in zip(todo, results):
+        codes[mod_name] = raw_code
+        if cache_dir is not None:
+            cache_file = os.path.join(cache_dir, keys[mod_name])
+            tmp = '{}.{}.tmp'.format(cache_file, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(raw_code)
+            os.rename(tmp, cache_file)
+
+    return codes
+
+
+def var_name_of(mod_name):
+    """Return the C variable name holding the byte code of `mod_name`.
+
+    Every character other than [A-Za-z0-9] (including '_') is escaped
+    as _XX (the hex value of each UTF-8 byte), so distinct module
+    names (e.g.: a.b and a__b, or names containing '-') always give
+    distinct, valid identifiers.
+
+    """
+    return 'M_' + ''.join(chr(b) if chr(b).isalnum() and b < 0x80 else '_{:02x}'.format(b)
+                          for b in mod_name.encode())
+
+
+def shard_of(mod_name, shards):
+    """Return the shard that module `mod_name` is placed in.
+
+    The shard only depends on the module name, so adding or changing
+    modules doesn't move other modules between shards.
+
+    """
+    return int(hashlib.sha256(mod_name.encode()).hexdigest()[:8], 16) % shards
+
+
+def write_if_changed(filename, data):
+    """Write `data` (a str or bytes) to `filename`, unless the file already
+    has exactly that content. This avoids updating the modification
+    time of unchanged files, so they aren't needlessly recompiled.
+
+    """
+    mode = 'b' if isinstance(data, bytes) else ''
+    if os.path.exists(filename):
+        with open(filename, 'r' + mode) as f:
+            if f.read() == data:
+                return False
+    with open(filename, 'w' + mode) as f:
+        f.write(data)
+    return True
+
+
+def create_frozen_lib(name, mods, aliases={}, encoding='dec', jobs=1, shards=None, cache_dir=None,
+                      compress=False, uncompressed=[]):
     """Create a new *frozen library* called `name`.
 
     `mods` is a dictionary of module descriptions indexed by module
@@ -242,10 +953,39 @@ def create_frozen_lib(name, mods, aliases={}):
     dictionary indexed by the alias name, with the value being the
     name of the underlying module.
 
+    `encoding` selects how the byte code is written (see ENCODINGS).
+    With the 'incbin' encoding the library is written as a `{name}.S`
+    assembler file and `{name}.bin` binary blob, rather than `{name}.c`.
+    The `{name}.S` file must be assembled with `{name}.bin` in the
+    include path (e.g.: the current directory).
+
+    Modules are compiled (and formatted) by `jobs` processes in
+    parallel. The output is identical regardless of the number of jobs.
+
+    If `shards` is specified the library is split in to that many C
+    files, `{name}_0.c` to `{name}_<shards-1>.c` (and a `{name}.mk`
+    Makefile fragment listing them in `{name}_SRCS`), which can be
+    compiled in parallel. A shard file is only rewritten when the
+    modules in it change, so only changed shards are recompiled.
+
+    If `cache_dir` is specified compiled modules are cached, so only
+    changed modules are recompiled (see `compile_modules`).
+
+    If `compress` is True, the modules (other than those listed in
+    `uncompressed`, and those with aliases) are zlib compressed and
+    stored in a single blob, `Z_{name}`, in `{name}_z.c`. The
+    compressed modules are described by `{name}_zstruct.h` rather than
+    `{name}_struct.h`. An app created from the library installs an
+    importer that decompresses each module when it is first imported.
+    Any modules imported while the interpreter is initialised must be
+    listed in `uncompressed`.
+
     """
+    if shards is not None and shards < 1:
+        raise Exception("The number of shards must be at least 1 (not {}).".format(shards))
     extern_fmt = 'extern unsigned char {}[];\n'
     struct_fmt = '    {{"{}", {}, {}}},\n'
-    c_filename = '{}.c'.format(name)
+    suffix = '.S' if encoding == 'incbin' else '.c'
     h_struct_filename = '{}_struct.h'.format(name)
     h_extern_filename = '{}_extern.h'.format(name)
 
@@ -253,31 +993,114 @@ def create_frozen_lib(name, mods, aliases={}):
     # the code is simpler if we have {module: [aliases]}
     aliases = dict_inverse(aliases)
 
-    with open(h_struct_filename, 'w') as h_struct, \
-            open(h_extern_filename, 'w') as h_ext, \
-            open(c_filename, 'w') as c_out:
-
-        for mod_name in sorted(mods.keys()):
-            (filename, short_filename, is_pkg) = mods[mod_name]
-            with tokenize.open(filename) as f:
-                code = compile(f.read(), short_filename, 'exec', optimize=2)
-            var_name = "M_" + "__".join(mod_name.split("."))
-            raw_code = marshal.dumps(code)
-            size = len(raw_code)
-            # Packages are indicated by negative size; this is part of
-            # the Pythohn frozen library internals.
-            if is_pkg:
-                size = -size
-
-            write_byte_code(c_out, var_name, raw_code)
-
-            h_ext.write(extern_fmt.format(var_name))
-
-            h_struct.write(struct_fmt.format(mod_name, var_name, size))
-
-            # Write out all the aliases
-            for alias in aliases.get(mod_name, []):
-                h_struct.write(struct_fmt.format(alias, var_name, size))
+    names = sorted(mods.keys())
+    var_names = {mod_name: var_name_of(mod_name) for mod_name in names}
+    codes = compile_modules(mods, names, jobs, cache_dir)
+
+    # Modules with aliases (e.g.: __main__ or _frozen_importlib) are
+    # imported directly from the frozen modules table, so are never
+    # compressed.
+    if compress:
+        znames = [n for n in names if n not in aliases and n not in uncompressed]
+        names = [n for n in names if n in aliases or n in uncompressed]
+    else:
+        znames = []
+
+    h_struct = []
+    h_ext = []
+    for mod_name in names:
+        var_name = var_names[mod_name]
+        size = len(codes[mod_name])
+        # Packages are indicated by negative size; this is part of
+        # the Pythohn frozen library internals.
+        if mods[mod_name][2]:
+            size = -size
+
+        h_ext.append(extern_fmt.format(var_name))
+
+        h_struct.append(struct_fmt.format(mod_name, var_name, size))
+
+        # Write out all the aliases
+        for alias in aliases.get(mod_name, []):
+            h_struct.append(struct_fmt.format(alias, var_name, size))
+
+    if shards is None:
+        groups = [(name, names)]
+    else:
+        groups = [('{}_{}'.format(name, i), [n for n in names if shard_of(n, shards) == i])
+                  for i in range(shards)]
+
+    zstruct_filename = '{}_zstruct.h'.format(name)
+    if znames:
+        # The compressed modules are stored in a single blob, which is
+        # treated like a module in its own group.
+        zkey = ' zblob'
+        var_names[zkey] = 'Z_{}'.format(name)
+        h_ext.append(extern_fmt.format(var_names[zkey]))
+        blob = []
+        offset = 0
+        zstruct = []
+        for mod_name in znames:
+            zcode = zlib.compress(codes[mod_name], 9)
+            blob.append(zcode)
+            zstruct.append(ZSTRUCT_FMT.format(mod_name, var_names[zkey], offset, len(zcode),
+                                              len(codes[mod_name]), int(mods[mod_name][2])))
+            offset += len(zcode)
+        codes[zkey] = b''.join(blob)
+        groups.append(('{}_z'.format(name), [zkey]))
+        write_if_changed(zstruct_filename, ''.join(zstruct))
+    elif os.path.exists(zstruct_filename):
+        os.unlink(zstruct_filename)
+
+    if shards is not None:
+        write_if_changed('{}.mk'.format(name), '{}_SRCS = {}\n'.format(
+                name, ' '.join(base + suffix for base, _ in groups)))
+        # Remove any shards left by a previous, larger, number of shards.
+        lib_dir, lib_name = os.path.split(name)
+        shard_re = re.compile(r'{}_(\d+)\.(c|S|bin)$'.format(re.escape(lib_name)))
+        for filename in os.listdir(lib_dir or '.'):
+            m = shard_re.match(filename)
+            if m is not None and int(m.group(1)) >= shards:
+                os.unlink(os.path.join(lib_dir, filename))
+
+    if encoding == 'incbin':
+        for base, group in groups:
+            blob_filename = '{}.bin'.format(base)
+            c_out = io.StringIO()
+            c_out.write(INCBIN_HEADER)
+            offset = 0
+            for mod_name in group:
+                write_incbin(c_out, var_names[mod_name], blob_filename, offset, len(codes[mod_name]))
+                offset += len(codes[mod_name])
+            write_if_changed(blob_filename, b''.join(codes[mod_name] for mod_name in group))
+            write_if_changed(base + suffix, c_out.getvalue())
+    else:
+        # Each shard starts with a digest of its contents, so that
+        # unchanged shards don't need to be formatted.
+        todo = []
+        for base, group in groups:
+            h = hashlib.sha256(encoding.encode())
+            for mod_name in group:
+                h.update(var_names[mod_name].encode())
+                h.update(codes[mod_name])
+            digest = '/* Generated by freeze.py: {} */\n'.format(h.hexdigest()) if shards is not None else ''
+            if digest and os.path.exists(base + suffix):
+                with open(base + suffix) as f:
+                    if f.readline() == digest:
+                        continue
+            todo.append((base, group, digest))
+
+        format_jobs = [(var_names[mod_name], codes[mod_name], encoding)
+                       for _, group, _ in todo for mod_name in group]
+        texts = pool_map(format_module, format_jobs, jobs)
+        for base, group, digest in todo:
+            with open(base + suffix, 'w') as c_out:
+                c_out.write(digest)
+                for _ in group:
+                    c_out.write(next(texts))
+
+    write_if_changed(h_struct_filename, ''.join(h_struct))
+    write_if_changed(h_extern_filename, ''.join(h_ext))
 
 
 def find_modules(libdir, excluded=[]):
@@ -339,11 +1162,207 @@ def find_modules(libdir, excluded=[]):
     return modules
 
 
+def _const_str(node):
+    """Return the value of `node` if it is a string constant, else None."""
+    value = getattr(node, 'value', getattr(node, 's', None))
+    return value if isinstance(value, str) else None
+
+
+def module_imports(filename, mod_name='__main__', is_pkg=False):
+    """Return the set of module names that may be imported by the module
+    in `filename`.
+
+    This is a static analysis of the import statements, so the set
+    will include names that are not modules (e.g.: `from os import
+    path` yields both `os` and `os.path`). Calls to `__import__` and
+    `importlib.import_module` with a constant module name are also
+    included. Relative imports are resolved using `mod_name` and
+    `is_pkg`.
+
+    """
+    with tokenize.open(filename) as f:
+        tree = ast.parse(f.read(), filename)
+
+    package = mod_name if is_pkg else mod_name.rpartition('.')[0]
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                names.add(alias.name)
+        elif isinstance(node, ast.ImportFrom):
+            base = package
+            if node.level:
+                for _ in range(node.level - 1):
+                    base = base.rpartition('.')[0]
+                if node.module:
+                    base = base + '.' + node.module if base else node.module
+            else:
+                base = node.module
+            if base:
+                names.add(base)
+                for alias in node.names:
+                    names.add(base + '.' + alias.name)
+        elif isinstance(node, ast.Call) and node.args:
+            func = node.func
+            func_name = getattr(func, 'id', getattr(func, 'attr', None))
+            name = _const_str(node.args[0])
+            if func_name in ('__import__', 'import_module') and name is not None:
+                names.add(name)
+    return names
+
+
+def prune_modules(mods, entries, allowed=[], roots=STDLIB_BOOTSTRAP_LIST, app_mods={}):
+    """Prune the `mods` dictionary of module descriptions to only the
+    modules reachable (by import) from the `entries`.
+
+    `entries` is a list of Python filenames (such as an application's
+    main module). Modules are also reachable from the modules in
+    `roots` (which default to the modules imported when the interpreter
+    starts), and from any module that prefix matches a module listed in
+    `allowed`. `allowed` should list packages that may be imported
+    dynamically (e.g.: by plugins), and can't be found statically.
+
+    `app_mods` is a dictionary of module descriptions of the
+    application's own modules (e.g.: from `find_modules`). Their
+    imports are followed too, so modules only imported by the
+    application's modules are kept, but the application's modules
+    themselves are not.
+
+    Returns a pair of dictionaries of module descriptions: the
+    reachable modules and the dropped modules.
+
+    """
+    todo = list(roots)
+    for entry in entries:
+        todo.extend(module_imports(entry))
+    for mod_name in mods:
+        for a in allowed:
+            if mod_name == a or mod_name.startswith(a + '.'):
+                todo.append(mod_name)
+
+    kept = {}
+    app_seen = set()
+    while todo:
+        mod_name = todo.pop()
+        if mod_name in app_mods and mod_name not in app_seen:
+            app_seen.add(mod_name)
+            (filename, short_filename, is_pkg) = app_mods[mod_name]
+            todo.append(mod_name.rpartition('.')[0])
+            todo.extend(module_imports(filename, mod_name, is_pkg))
+        if mod_name in kept or mod_name not in mods:
+            continue
+        (filename, short_filename, is_pkg) = mods[mod_name]
+        kept[mod_name] = mods[mod_name]
+        parent = mod_name.rpartition('.')[0]
+        if parent:
+            todo.append(parent)
+        todo.extend(module_imports(filename, mod_name, is_pkg))
+
+    dropped = {mod_name: mod for mod_name, mod in mods.items() if mod_name not in kept}
+    return kept, dropped
+
+
+def write_prune_report(filename, kept, dropped):
+    """Write a report on the modules dropped by `prune_modules` to
+    `filename`. The size saved is reported in bytes of module source.
+    Returns the summary line of the report.
+
+    """
+    kept_size = sum(os.path.getsize(mod[0]) for mod in kept.values())
+    dropped_sizes = {mod_name: os.path.getsize(mod[0]) for mod_name, mod in dropped.items()}
+    dropped_size = sum(dropped_sizes.values())
+    summary = 'Dropped {} of {} modules ({} of {} source bytes)'.format(
+        len(dropped), len(kept) + len(dropped), dropped_size, kept_size + dropped_size)
+    with open(filename, 'w') as f:
+        f.write(summary + '\n\n')
+        for mod_name in sorted(dropped):
+            f.write('{} {}\n'.format(mod_name, dropped_sizes[mod_name]))
+    return summary
+
+
+# Sections of a Modules/Setup file, and whether the modules in them
+# are statically linked (modules before any section are static).
+SETUP_SECTIONS = {'*static*': True, '*noconfig*': True, '*shared*': False, '*disabled*': False}
+SETUP_VARIABLE_RE = re.compile(r'[A-Za-z_][A-Za-z_0-9]*\s*=')
+EXTENSION_NAME_RE = re.compile(r'[A-Za-z_][A-Za-z_0-9]*(\.[A-Za-z_][A-Za-z_0-9]*)*$')
+
+
+def default_setup():
+    """Return the path of the Modules/Setup file used to build the
+    running Python (as installed by `make libainstall`).
+
+    """
+    return os.path.join(sysconfig.get_config_var('LIBPL'), 'Setup')
+
+
+def read_setup(filename):
+    """Return the names of the statically linked extension modules
+    listed in a Modules/Setup file `filename`.
+
+    """
+    with open(filename) as f:
+        text = f.read().replace('\\\n', ' ')
+    static = True
+    modules = []
+    for line in text.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if not line or SETUP_VARIABLE_RE.match(line):
+            continue
+        if line in SETUP_SECTIONS:
+            static = SETUP_SECTIONS[line]
+        elif static:
+            modules.append(line.split()[0])
+    return modules
+
+
+def static_extensions(setup=None):
+    """Return the statically linked extension modules (from the
+    Modules/Setup file `setup`, or `default_setup` by default) that
+    are not already built in to the interpreter.
+
+    Modules in the *static* section are normally already built in (via
+    config.c); modules in the *noconfig* section are compiled in to
+    libpython but not added to the built in modules table, so are only
+    importable if added by the app (see `create_app`).
+
+    This assumes ice is run by the Python the app will be linked with.
+
+    """
+    if setup is None:
+        setup = default_setup()
+    return [m for m in read_setup(setup) if m not in sys.builtin_module_names]
+
+
+def extension_init(name):
+    """Return the name of the PyInit function of extension module
+    `name`. As for shared extensions, this is named after the last
+    component of a dotted (package) module name.
+
+    """
+    if not EXTENSION_NAME_RE.match(name):
+        raise Exception("Invalid extension module name: {!r}".format(name))
+    return 'PyInit_{}'.format(name.rpartition('.')[2])
+
+
+def find_shared_extensions(libdir):
+    """Return the names of the shared extension modules in `libdir`."""
+    import importlib.machinery
+    suffixes = sorted(importlib.machinery.EXTENSION_SUFFIXES, key=len, reverse=True)
+    names = set()
+    for fn in os.listdir(libdir):
+        for suffix in suffixes:
+            if fn.endswith(suffix):
+                names.add(fn[:-len(suffix)])
+                break
+    return sorted(names)
+
+
 def merge_dict(dict1, dict2):
     return dict(list(dict1.items()) + list(dict2.items()))
 
 
-def create_stdlib(excluded=STDLIB_EXCLUDE_LIST):
+def create_stdlib(excluded=STDLIB_EXCLUDE_LIST, encoding='dec', jobs=1, shards=None, cache_dir=None,
+                  entries=None, allowed=[], compress=False, paths=[]):
     """Create a frozen version of the standard library.
 
     The location of the standard library is determined automatically
@@ -352,17 +1371,46 @@ def create_stdlib(excluded=STDLIB_EXCLUDE_LIST):
     Specific modules can be excluded with the frozen library. `excluded`
     is a list of modules to exclude (via a simple prefix match).
 
+    If `entries` (a list of Python filenames) is specified, only the
+    modules reachable from the entries (and the `allowed` packages) are
+    frozen (see `prune_modules`). The imports of the application's own
+    modules, found in the `paths` directories (as for `create_lib`),
+    are followed too. The dropped modules are reported in
+    `stdlib_pruned.txt`.
+
+    If `compress` is True, all the modules except those needed to
+    initialise the interpreter are compressed (see `create_frozen_lib`).
+
     """
-    version = sys.version[:3]
+    version = '{}.{}'.format(*sys.version_info[:2])
     libdir = os.path.join(sys.prefix, 'lib', 'python{}'.format(version))
     elibdir = os.path.join(sys.exec_prefix, 'lib', 'python{}'.format(version), 'lib-dynload')
-    create_frozen_lib('stdlib',
-                      merge_dict(find_modules(libdir, excluded=excluded),
-                                 find_modules(elibdir, excluded=excluded)),
-                      {'_frozen_importlib': 'importlib._bootstrap'})
-
-
-def create_lib(name, path, main=None):
+    mods = merge_dict(find_modules(libdir, excluded=excluded),
+                      find_modules(elibdir, excluded=excluded))
+    if os.path.isdir(elibdir):
+        shared = find_shared_extensions(elibdir)
+        if shared:
+            print("Warning: shared extension modules can't be frozen (build them statically "
+                  "in Modules/Setup): {}".format(' '.join(shared)))
+    if entries is not None:
+        app_mods = {}
+        for path in paths:
+            app_mods.update(find_modules(path))
+        mods, dropped = prune_modules(mods, entries, allowed, app_mods=app_mods)
+        print(write_prune_report('stdlib_pruned.txt', mods, dropped))
+    uncompressed = []
+    if compress:
+        uncompressed = prune_modules(mods, [])[0]
+    aliases = {'_frozen_importlib': 'importlib._bootstrap'}
+    if 'importlib._bootstrap_external' in mods:
+        # Python 3.5 and later also import this while initialising.
+        aliases['_frozen_importlib_external'] = 'importlib._bootstrap_external'
+    create_frozen_lib('stdlib', mods, aliases,
+                      encoding=encoding, jobs=jobs, shards=shards, cache_dir=cache_dir,
+                      compress=compress, uncompressed=uncompressed)
+
+
+def create_lib(name, path, main=None, encoding='dec', jobs=1, shards=None, cache_dir=None, compress=False):
     """Create a new frozen library with modules from the specified
     path. `main` can be set to the name of a module, which will be
     aliases as '__main__' in the frozen library.
@@ -375,10 +1423,11 @@ def create_lib(name, path, main=None):
     aliases = {}
     if main is not None:
         aliases['__main__'] = main
-    create_frozen_lib(name, mods, aliases)
+    create_frozen_lib(name, mods, aliases, encoding=encoding, jobs=jobs, shards=shards, cache_dir=cache_dir,
+                      compress=compress)
 
 
-def create_app(libs, filename='main.c'):
+def create_app(libs, filename='main.c', index=True, extensions=[], profile=False):
     """Create an application from a list of frozen libraries.
 
     One (and only one) of the frozen libraries should have been
@@ -387,13 +1436,40 @@ def create_app(libs, filename='main.c'):
     The application is output in file `filename` (which defaults to
     main.c
 
+    If `index` is True (the default), the application includes a hash
+    index of all the frozen modules, and an importer that uses it
+    (rather than the standard importer, which searches the frozen
+    modules linearly).
+
+    If any of the libraries were created with compressed modules the
+    application must be linked with zlib (-lz).
+
+    `extensions` is a list of statically linked extension modules
+    (see `static_extensions`) that are added to the built in modules
+    table, so they are imported without searching the filesystem. The
+    application must be linked with the objects (or library) providing
+    each module's PyInit function (see `extension_init`).
+
+    If `profile` is True, the application reports the time taken to
+    initialise the interpreter, and the time (and byte code size) of
+    each module imported (see PROFILE_SRC and `profile_app`).
+
     NOTE: In the future create_app may directly specify the module
     to use as __main__, rather than relying on a create_lib.
 
     """
+    compressed = [l for l in libs if os.path.exists('{}_zstruct.h'.format(l))]
+    # The uncompressed modules are only needed for the index and the
+    # profiler's module sizes; otherwise they are found by the
+    # standard frozen importer.
+    all_entries = [e for l in libs for e in read_structs(l, uncompressed=index or profile)]
+    if index:
+        entries = all_entries
+    else:
+        entries = [e for e in all_entries if e[3] != 0]
+
     with open(filename, 'w') as outf:
         outf.write(HEADER)
-        outf.write(MAIN_FN)
 
         for l in libs:
             with open('{}_extern.h'.format(l)) as f:
@@ -406,6 +1482,136 @@ def create_app(libs, filename='main.c'):
 
         outf.write(ARRAY_TRAILER)
 
+        pre_init = ''
+        post_init = ''
+        if extensions:
+            init_fns = [extension_init(ext) for ext in extensions]
+            for init_fn in sorted(set(init_fns)):
+                outf.write('extern PyObject *{}(void);\n'.format(init_fn))
+            outf.write(INITTAB_HEADER)
+            for ext, init_fn in zip(extensions, init_fns):
+                outf.write('    {{"{}", {}}},\n'.format(ext, init_fn))
+            outf.write(INITTAB_TRAILER)
+            pre_init += '    PyImport_ExtendInittab(_xyz_inittab);\n'
+        if entries:
+            if compressed:
+                outf.write('#define XYZ_FROZEN_COMPRESSED\n')
+            outf.write(FROZEN_MODULE_HEADER)
+            for e in entries:
+                outf.write(ZSTRUCT_FMT.format(*e))
+            outf.write(FROZEN_MODULE_TRAILER)
+            if index:
+                table = build_index([e[0] for e in entries])
+                outf.write(FROZEN_INDEX_HEADER.format(mask=len(table) - 1))
+                for i in range(0, len(table), 16):
+                    outf.write('    {},\n'.format(', '.join(str(x) for x in table[i:i + 16])))
+                outf.write(FROZEN_INDEX_TRAILER)
+            outf.write(FROZEN_MODULE_FUNCS)
+            pre_init += '    PyImport_AppendInittab("_xyz_frozen", PyInit__xyz_frozen);\n'
+            post_init += '    if (xyz_run_source("_xyz_frozen_importer",\n{}) < 0)\n        return -1;\n'.format(
+                c_string(FROZEN_IMPORTER))
+
+        if profile:
+            outf.write(PROFILE_FN)
+            sizes = {}
+            for name, _, _, csize, usize, _ in all_entries:
+                sizes.setdefault(name, (usize, csize))
+            pre_init = '    xyz_init_start = xyz_time();\n' + pre_init
+            # The profiler is installed before anything else is imported.
+            post_init = ('    if (xyz_set_init_time() < 0 ||\n'
+                         '        xyz_run_source("_xyz_profile",\n{}) < 0)\n'
+                         '        return -1;\n').format(c_string('SIZES = {!r}\n'.format(sizes) + PROFILE_SRC)) + post_init
+
+        if post_init:
+            outf.write(RUN_SOURCE_FN)
+        outf.write(INIT_FMT.format(pre_init=pre_init, post_init=post_init))
+        outf.write(MAIN_FN)
+
+
+# Runs ENTRY as __main__, after the profiler (see `profile_filesystem`).
+PROFILE_RUN_SRC = """
+sys.argv = [ENTRY]
+sys.path[0] = os.path.dirname(os.path.abspath(ENTRY))
+with open(ENTRY, 'rb') as f:
+    code = compile(f.read(), ENTRY, 'exec')
+exec(code, {'__name__': '__main__', '__file__': ENTRY, '__builtins__': __builtins__})
+"""
+
+
+def profile_app(app, output, args=[]):
+    """Run an app (created with profile=True), writing its import
+    profile to `output`.
+
+    """
+    env = dict(os.environ, XYZ_IMPORT_PROFILE=os.path.abspath(output))
+    subprocess.check_call([os.path.abspath(app)] + list(args), env=env)
+
+
+def profile_filesystem(entry, output, args=[]):
+    """Run the Python file `entry` with the running Python (and so the
+    filesystem standard library), writing its import profile to
+    `output`. The profile matches that from `profile_app`, except the
+    interpreter initialisation and module sizes are not reported.
+
+    """
+    src = 'SIZES = {{}}\nENTRY = {!r}\n'.format(entry) + PROFILE_SRC + PROFILE_RUN_SRC
+    env = dict(os.environ, XYZ_IMPORT_PROFILE=os.path.abspath(output))
+    subprocess.check_call([sys.executable, '-c', src] + list(args), env=env)
+
+
+def read_profile(filename):
+    """Read an import profile. Returns a tuple (init_time, modules)
+    where modules is a dictionary of (self, cumulative, size,
+    compressed_size) tuples indexed by module name. Times are in
+    microseconds; init_time and sizes are None if not known.
+
+    """
+    init_time = None
+    modules = {}
+    with open(filename) as f:
+        for line in f:
+            if not line.startswith('import time: '):
+                continue
+            line = line[len('import time: '):]
+            if line.startswith('init [us]: '):
+                init_time = int(line.split(':')[1])
+                continue
+            fields = [x.strip() for x in line.split('|')]
+            if len(fields) != 5 or not fields[0].isdigit():
+                continue
+            sizes = [int(x) if x.isdigit() else None for x in fields[2:4]]
+            modules[fields[4]] = (int(fields[0]), int(fields[1])) + tuple(sizes)
+    return init_time, modules
+
+
+def compare_profiles(app_profile, fs_profile, top=None):
+    """Return a report comparing the import profiles of an app and the
+    filesystem standard library, with the modules ordered by the time
+    spent importing them in the app.
+
+    """
+    app_init, app_mods = read_profile(app_profile)
+    _, fs_mods = read_profile(fs_profile)
+    names = sorted(app_mods, key=lambda n: app_mods[n][0], reverse=True)
+    if top is not None:
+        names = names[:top]
+    row_fmt = '{:40} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}'
+    lines = [row_fmt.format('module', 'size', 'compressed', 'self [us]', 'cumulative', 'fs self', 'fs cumul.')]
+    missing = ('-', '-')
+    for name in names:
+        self_time, cumulative, size, csize = app_mods[name]
+        lines.append(row_fmt.format(name, size or '-', csize or '-', self_time, cumulative,
+                                    *fs_mods.get(name, missing)[:2]))
+    lines.append('')
+    if app_init is not None:
+        lines.append('Initialisation: {} us'.format(app_init))
+    lines.append('Imports: {} us (app), {} us (filesystem)'.format(
+            sum(m[0] for m in app_mods.values()), sum(m[0] for m in fs_mods.values())))
+    only_fs = sorted(set(fs_mods) - set(app_mods))
+    if only_fs:
+        lines.append('Only imported from the filesystem: {}'.format(' '.join(only_fs)))
+    return '\n'.join(lines)
+
 
 def main(argv):
     import argparse
@@ -414,27 +1620,71 @@ def main(argv):
     subparsers = parser.add_subparsers(dest='command')
 
     stdlib_p = subparsers.add_parser('stdlib', help='Create frozen standard library.')
+    stdlib_p.add_argument('--entry', action='append', default=None,
+                          help='only freeze modules reachable from this Python file')
+    stdlib_p.add_argument('--allow', action='append', default=[],
+                          help='package to freeze even if not reachable from an entry')
+    stdlib_p.add_argument('--path', dest='paths', action='append', default=[],
+                          help='directory of the application\'s modules, whose imports are followed from the entries')
 
     lib_p = subparsers.add_parser('lib', help='Create frozen library')
     lib_p.add_argument('name', help='library name')
     lib_p.add_argument('path', help='library path')
     lib_p.add_argument('--main', default=None, help='library path')
 
+    for p in (stdlib_p, lib_p):
+        p.add_argument('--encoding', choices=ENCODINGS, default='dec',
+                       help='byte code encoding (default: dec)')
+        p.add_argument('-j', dest='jobs', type=int, default=1,
+                       help='number of modules to compile in parallel (default: 1)')
+        p.add_argument('--shards', type=int, default=None,
+                       help='split the library in to this many C files')
+        p.add_argument('--cache-dir', default=None,
+                       help='directory used to cache compiled modules')
+        p.add_argument('--compress', action='store_true', default=False,
+                       help='compress modules, and decompress them when first imported')
+
     app_p = subparsers.add_parser('app', help='Create app main.c from frozen libraries')
     app_p.add_argument('libs', nargs='+', help='libraries')
+    app_p.add_argument('--no-index', dest='index', action='store_false', default=True,
+                       help='use the standard (linear) frozen module lookup')
+    app_p.add_argument('--profile', action='store_true', default=False,
+                       help='report the time taken by each import (see XYZ_IMPORT_PROFILE)')
+    app_p.add_argument('--setup', nargs='?', const='', default=None,
+                       help='add the static extension modules from this Modules/Setup file '
+                       '(default: the Setup file of the running Python)')
+    app_p.add_argument('--extension', dest='extensions', action='append', default=[],
+                       help='add a statically linked extension module to the built in modules table')
+
+    profile_p = subparsers.add_parser('profile', help='Compare the imports of an app with the filesystem stdlib')
+    profile_p.add_argument('app', help='app created with --profile')
+    profile_p.add_argument('entry', help='Python file with the same code as the app\'s __main__')
+    profile_p.add_argument('--top', type=int, default=None, help='only report the slowest modules')
 
     args = parser.parse_args()
 
+    if getattr(args, 'shards', None) is not None and args.shards < 1:
+        parser.error("--shards must be at least 1")
+
     if args.command is None:
         parser.print_help()
         return 1
 
     if args.command == 'stdlib':
-        create_stdlib()
+        create_stdlib(encoding=args.encoding, jobs=args.jobs, shards=args.shards, cache_dir=args.cache_dir,
+                      entries=args.entry, allowed=args.allow, compress=args.compress, paths=args.paths)
     elif args.command == 'lib':
-        create_lib(args.name, args.path, args.main)
+        create_lib(args.name, args.path, args.main, encoding=args.encoding, jobs=args.jobs,
+                   shards=args.shards, cache_dir=args.cache_dir, compress=args.compress)
     elif args.command == 'app':
-        create_app(args.libs)
+        extensions = list(args.extensions)
+        if args.setup is not None:
+            extensions += [m for m in static_extensions(args.setup or None) if m not in extensions]
+        create_app(args.libs, index=args.index, extensions=extensions, profile=args.profile)
+    elif args.command == 'profile':
+        profile_app(args.app, 'profile_app.txt')
+        profile_filesystem(args.entry, 'profile_filesystem.txt')
+        print(compare_profiles('profile_app.txt', 'profile_filesystem.txt', args.top))
 
     return 0
 
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""Deterministic, parallel byte compilation of Python modules.
+
+This is an alternative to `compileall` for packaging. Every .py file
+in the specified directories is compiled to both unoptimised (.pyc)
+and optimised (.pyo, or .opt-1.pyc) byte code, in the standard
+__pycache__ location.
+
+Unlike compileall:
+
+1) Files are compiled in parallel (-jN).
+
+2) The output is deterministic. The hash seed is fixed (the script
+re-executes itself with PYTHONHASHSEED=0 if required), and the
+timestamp in the byte code header is specified (--mtime) rather than
+taken from the source file. The output is identical regardless of the
+number of jobs.
+
+This must be run by the same version of Python that will import the
+byte code. It only uses the standard library, so it can be run by a
+freshly built Python that hasn't been installed (it supports Python 3.3
+onwards).
+
+Usage:
+
+% pycompile.py -j4 --mtime 1356998400 -d /noprefix/lib/python3.3 install/noprefix/lib/python3.3
+
+"""
+import marshal
+import multiprocessing
+import os
+import re
+import struct
+import sys
+
+# The same exclusions as CPython's `make libinstall`.
+DEFAULT_EXCLUDE = r'bad_coding|badsyntax|site-packages|lib2to3/tests/data'
+
+OPTIMIZE_LEVELS = [0, 1]
+
+
+def magic_number():
+    if sys.version_info >= (3, 4):
+        import importlib.util
+        return importlib.util.MAGIC_NUMBER
+    else:
+        import imp
+        return imp.get_magic()
+
+
+def cache_file(filename, optimize):
+    """Return the byte code filename for a source `filename`."""
+    if sys.version_info >= (3, 5):
+        import importlib.util
+        return importlib.util.cache_from_source(filename, optimization=optimize or '')
+    else:
+        import imp
+        return imp.cache_from_source(filename, debug_override=not optimize)
+
+
+def header(mtime, source_size):
+    """Return the byte code header for the running Python."""
+    h = magic_number()
+    if sys.version_info >= (3, 7):
+        # Flags (0 for a timestamp based pyc).
+        h += struct.pack('<I', 0)
+    h += struct.pack('<I', mtime & 0xFFFFFFFF)
+    if sys.version_info >= (3, 3):
+        h += struct.pack('<I', source_size & 0xFFFFFFFF)
+    return h
+
+
+def write_file(filename, data):
+    """Atomically write `data` to `filename`."""
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, filename)
+
+
+def compile_file(job):
+    """Compile a single file. `job` is a tuple of (filename, dfile,
+    mtime), where `dfile` is the filename stored in the byte code.
+
+    Returns None on success, or an error message.
+
+    """
+    filename, dfile, mtime = job
+    with open(filename, 'rb') as f:
+        source = f.read()
+    for optimize in OPTIMIZE_LEVELS:
+        try:
+            code = compile(source, dfile, 'exec', dont_inherit=True, optimize=optimize)
+        except (SyntaxError, ValueError) as e:
+            return '{}: {}'.format(filename, e)
+        cfile = cache_file(filename, optimize)
+        if not os.path.exists(os.path.dirname(cfile)):
+            try:
+                os.makedirs(os.path.dirname(cfile))
+            except OSError:
+                # Another worker may have created it.
+                pass
+        write_file(cfile, header(mtime, len(source)) + marshal.dumps(code))
+    return None
+
+
+def find_sources(directory, ddir=None, exclude=None):
+    """Return a sorted list of (filename, dfile) tuples for the .py
+    files in `directory`. If `ddir` is specified the stored filename
+    `dfile` is relative to `ddir` rather than `directory`.
+
+    """
+    sources = []
+    for root, dirs, files in os.walk(directory):
+        if '__pycache__' in dirs:
+            dirs.remove('__pycache__')
+        for fn in files:
+            if not fn.endswith('.py'):
+                continue
+            filename = os.path.join(root, fn)
+            if exclude is not None and exclude.search(filename):
+                continue
+            dfile = filename
+            if ddir is not None:
+                dfile = os.path.join(ddir, os.path.relpath(filename, directory))
+            sources.append((filename, dfile))
+    return sorted(sources)
+
+
+def pycompile(directories, mtime, ddir=None, exclude=DEFAULT_EXCLUDE, jobs=1):
+    """Compile the .py files in `directories`. Returns a list of
+    errors (files that couldn't be compiled).
+
+    """
+    exclude = re.compile(exclude) if exclude else None
+    jobs_list = [(filename, dfile, mtime)
+                 for d in directories for filename, dfile in find_sources(d, ddir, exclude)]
+    if jobs == 1:
+        results = map(compile_file, jobs_list)
+        return [e for e in results if e is not None]
+    with multiprocessing.Pool(jobs) as pool:
+        results = pool.imap(compile_file, jobs_list, 16)
+        return [e for e in results if e is not None]
+
+
+def main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Deterministic, parallel byte compilation.')
+    parser.add_argument('directories', nargs='+', help='directories to compile')
+    parser.add_argument('-j', dest='jobs', type=int, default=1, help='simultaneous jobs (default: 1)')
+    parser.add_argument('--mtime', type=int, default=0, help='timestamp stored in the byte code header')
+    parser.add_argument('-d', dest='ddir', default=None, help='directory prepended to the stored filenames')
+    parser.add_argument('-x', dest='exclude', default=DEFAULT_EXCLUDE,
+                        help='skip files matching this regular expression')
+    args = parser.parse_args(argv[1:])
+
+    if sys.flags.hash_randomization:
+        # The hash seed can only be set when the interpreter starts.
+        env = dict((k, v) for k, v in os.environ.items() if not k.startswith('PYTHON'))
+        env['PYTHONHASHSEED'] = '0'
+        os.execve(sys.executable, [sys.executable, os.path.abspath(__file__)] + argv[1:], env)
+
+    errors = pycompile(args.directories, args.mtime, args.ddir, args.exclude, args.jobs)
+    for e in errors:
+        print("Unable to compile {}".format(e))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
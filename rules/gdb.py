@@ -1,3 +1,5 @@
+import hashlib
+import os
 import xyz
 
 class Gdb(xyz.Package):
@@ -6,6 +8,7 @@ class Gdb(xyz.Package):
         'target': ['arm-none-eabi']
         }
     uses_osx_frameworks = True
+    build_files = ['ice/ice.py']
 
     @property
     def deps(self):
@@ -19,9 +22,19 @@ class Gdb(xyz.Package):
 
         # After configuring we need to ice python, but we need
         # to ensure we do it using the built version of Python, not
-        # this Python
+        # this Python. The frozen stdlib only depends on the Python
+        # release and ice itself, so it is cached.
+        ice_py = self.j('{root_dir_abs}', 'ice', 'ice.py')
+        python_pkg = [dep_pkg for dep_pkg in self.dep_pkgs() if dep_pkg.pkg_name == 'python'][0]
+        python_release = os.path.abspath(python_pkg.release_file)
+        key = hashlib.sha256('{} {}'.format(xyz.sha256_file(python_release),
+                                            xyz.sha256_file(ice_py)).encode()).hexdigest()
+
+        def ice_stdlib(output_dir):
+            with xyz.chdir(output_dir):
+                self.cmd('{devtree_dir_abs}/{host}/bin/python3', ice_py, 'stdlib', '{jobs}')
+
         xyz.ensure_dir('gdb')
-        with xyz.chdir('gdb'):
-            self.cmd('{devtree_dir_abs}/{host}/bin/python3', '{root_dir_abs}/ice/ice.py', 'stdlib')
+        self.cached('ice-stdlib', key, ice_stdlib, 'gdb')
 
 rules = Gdb
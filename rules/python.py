@@ -2,13 +2,13 @@ import xyz
 import os
 import shutil
 import time
-import struct
 
 data_dir = os.path.abspath(os.path.dirname(__file__))
 
 class Python(xyz.Package):
     pkg_name = 'python'
     uses_osx_frameworks = True
+    build_files = ['rules/pySetup.dist.darwin', 'rules/pySetup.dist.linux', 'pycompile.py']
 
     def configure(self):
         if self.is_darwin():
@@ -25,21 +25,19 @@ class Python(xyz.Package):
         self.cmd('make', 'Makefile')
 
     def install(self):
+        # `make libinstall` byte compiles the library with PYTHON_FOR_BUILD,
+        # which is replaced with a no-op; the pycompile stage is used instead.
         with xyz.chdir(self.config['build_dir']), xyz.umask(0o022):
-            self.cmd('make', 'DESTDIR={install_dir_abs}',
+            self.cmd('make', 'DESTDIR={install_dir_abs}', 'PYTHON_FOR_BUILD=:',
                         'bininstall', 'inclinstall', 'libainstall', 'libinstall')
 
-        for root, _, files in os.walk(self.config['install_dir']):
-            for f in files:
-                if not (f.endswith('.pyc') or f.endswith('.pyo')):
-                    continue
-                with open(os.path.join(root, f), 'r+b') as outf:
-                    outf.seek(4)
-                    outf.write(struct.pack('I', xyz.BASE_TIME))
-
         # Remove lib2to3
         self.rmtree('{install_dir}', 'noprefix', 'lib', 'python3.3', 'lib2to3')
 
+        build_python = 'python.exe' if self.is_darwin() else 'python'
+        with xyz.umask(0o022):
+            self.pycompile(os.path.abspath(self.j('{build_dir}', build_python)), 'noprefix/lib/python3.3')
+
         for f in ['2to3', 'idle3', 'pydoc3', 'pyvenv']:
             bin_fn = self.j('{install_dir}', 'noprefix', '{host}', 'bin', f)
             os.unlink(bin_fn)
@@ -1,8 +1,9 @@
-import contextlib
+import fcntl
 import hashlib
 import os
 import shutil
 import subprocess
+import tempfile
 from functools import wraps
 
 
@@ -19,34 +20,77 @@ def rmtree(path):
         logger.info("Removing tree '{}'".format(path))
         shutil.rmtree(path)
 
-class _GeneratorSimpleContextManager(contextlib._GeneratorContextManager):
+# Trees removed in the background are first moved in to this directory
+# (next to the tree).
+TRASH_DIR = '.trash'
+
+
+def trash_tree(path):
+    """Remove the directory tree `path` in the background.
+
+    The tree is renamed in to a trash directory next to it (so on the
+    same filesystem), which frees `path` immediately, and then removed
+    by a background process. If the tree can't be renamed (e.g.: it is
+    a mount point) it is removed synchronously.
+
+    Anything left in the trash (e.g.: if the machine is restarted) is
+    removed by `reap_trash`.
+
+    """
+    if not os.path.lexists(path):
+        return
+    trash = os.path.join(os.path.dirname(path), TRASH_DIR)
+    try:
+        ensure_dir(trash)
+        dest = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', dir=trash)
+        os.rename(path, os.path.join(dest, os.path.basename(path)))
+    except OSError:
+        rmtree(path)
+        return
+    logger.info("Removing tree '{}' (in the background)".format(path))
+    _remove_background(dest)
+
+
+def reap_trash(directory):
+    """Remove (in the background) anything in the trash directory of
+    `directory` (see `trash_tree`).
+
+    """
+    trash = os.path.join(directory, TRASH_DIR)
+    if os.path.isdir(trash):
+        for name in os.listdir(trash):
+            _remove_background(os.path.join(trash, name))
+
+
+def _remove_background(path):
+    # The removal is done by a separate process (in its own session) so
+    # it continues even if this process exits.
+    subprocess.Popen(['rm', '-rf', path], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+class _GeneratorSimpleContextManager:
     """Helper for @simplecontextmanager decorator."""
 
+    def __init__(self, func, args, kwds):
+        self.gen = func(*args, **kwds)
+
+    def __enter__(self):
+        try:
+            return next(self.gen)
+        except StopIteration:
+            raise RuntimeError("generator didn't yield")
+
     def __exit__(self, type, value, traceback):
-        if type is None:
-            try:
-                next(self.gen)
-            except StopIteration:
-                return
-            else:
-                raise RuntimeError("generator didn't stop")
+        # Unlike contextlib.contextmanager, the cleanup is run (rather
+        # than any exception being thrown in to the generator), and any
+        # exception is always propagated.
+        try:
+            next(self.gen)
+        except StopIteration:
+            return False
         else:
-            if value is None:
-                # Need to force instantiation so we can reliably
-                # tell if we get the same exception back
-                value = type()
-
-            try:
-                next(self.gen)
-            except StopIteration as exc:
-                # Suppress the exception *unless* it's the same exception that
-                # was passed to throw().  This prevents a StopIteration
-                # raised inside the "with" statement from being suppressed
-                return exc is not value
-            else:
-                raise RuntimeError("generator didn't stop")
-            finally:
-                return False
+            raise RuntimeError("generator didn't stop")
 
 
 def simplecontextmanager(func):
@@ -77,7 +121,7 @@ def simplecontextmanager(func):
     """
     @wraps(func)
     def helper(*args, **kwds):
-        return _GeneratorSimpleContextManager(func, *args, **kwds)
+        return _GeneratorSimpleContextManager(func, args, kwds)
     return helper
 
 
@@ -114,6 +158,18 @@ def git_ver(path):
             source_ver += '*'
         return source_ver
 
+def git_remote_ver(url):
+    """Return the version (as `git_ver` would for a fresh clone) of the
+    git repository at `url`, without cloning it.
+
+    """
+    cmd = ['git', 'ls-remote', url, 'HEAD']
+    output = subprocess.check_output(cmd).decode().split()
+    if not output:
+        raise Exception("Unable to determine the version of {}".format(url))
+    return output[0]
+
+
 @simplecontextmanager
 def chdir(path):
     """Current-working directory context manager. Makes the current
@@ -158,3 +214,48 @@ def setenv(env):
             del os.environ[key]
         else:
             os.environ[key] = old_env[key]
+
+
+@simplecontextmanager
+def lock_file(path, wait=True):
+    """Exclusive file lock context manager. Locks `path` (which is
+    created if required) with flock for the duration of the context,
+    waiting for any other process that holds the lock.
+
+    If `wait` is False, the context doesn't wait, and its value is
+    False if the lock is held by another process (otherwise True).
+
+    """
+    if os.path.dirname(path):
+        ensure_dir(os.path.dirname(path))
+    f = open(path, 'a')
+    locked = True
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        if wait:
+            logger.info("Waiting for lock '{}'".format(path))
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            locked = False
+    yield locked
+    if locked:
+        fcntl.flock(f, fcntl.LOCK_UN)
+    f.close()
+
+
+def tree_size(path):
+    """Return the disk space (in bytes) used by the tree `path`,
+    excluding any trash directories in it (see `trash_tree`).
+
+    """
+    size = 0
+    for base, dirs, files in os.walk(path):
+        if TRASH_DIR in dirs:
+            dirs.remove(TRASH_DIR)
+        for name in dirs + files:
+            try:
+                size += os.lstat(os.path.join(base, name)).st_blocks * 512
+            except OSError:
+                pass
+    return size
@@ -5,14 +5,30 @@ A tool for building relocatable packages of UNIX applications.
 See README.md for details.
 """
 import calendar
+import collections
 import hashlib
+import io
+import itertools
+import json
 import logging
+import math
+import multiprocessing
+import multiprocessing.connection
 import os
 import platform
+import re
+import shutil
+import socket
+import stat
+import subprocess
 import sys
 import tarfile
+import time
+import urllib.error
+import urllib.request
 import util
-from util import sha256_file, rmtree, ensure_dir, touch, file_list, chdir, umask, setenv, git_ver
+from util import (sha256_file, rmtree, ensure_dir, touch, chdir, umask, setenv, git_ver, git_remote_ver, lock_file,
+                  trash_tree, reap_trash, tree_size, TRASH_DIR)
 
 # Location where all the git repo where the source is stored.
 SOURCE_REPO_PREFIX = 'git://github.com/BreakawayConsulting/'
@@ -27,6 +43,22 @@ util.logger = logger
 
 BASE_TIME = calendar.timegm((2013, 1, 1, 0, 0, 0, 0, 0, 0))
 
+# Memory assumed for each make job of a package with no recorded usage.
+DEFAULT_JOB_MEMORY = 1 << 30
+
+# Identifies the commands run by this invocation in the command log.
+BUILD_ID = '{}-{}'.format(time.strftime('%Y%m%dT%H%M%S', time.gmtime()), os.getpid())
+
+_xyz_version = None
+
+
+def xyz_version():
+    """Return the version (git commit) of XYZ itself."""
+    global _xyz_version
+    if _xyz_version is None:
+        _xyz_version = git_ver(os.path.dirname(os.path.abspath(__file__)))
+    return _xyz_version
+
 
 def tar_info_filter(tarinfo):
     tarinfo.uname = 'xyz'
@@ -69,6 +101,66 @@ def man_remove_header(m):
     os.rename(tmp, m)
 
 
+ROOTS = ['source', 'build', 'devtree', 'install', 'release', 'cache']
+
+
+def root_dirs(packaging_dir='', roots=None):
+    """Return a dictionary mapping each of the `ROOTS` to its directory.
+
+    By default each root is a directory of the same name in
+    `packaging_dir`. `roots` overrides the directory of specific roots,
+    e.g.: to put the build, devtree and install trees on fast scratch
+    storage.
+
+    """
+    dirs = dict((name, os.path.join(packaging_dir, name)) for name in ROOTS)
+    if roots is not None:
+        dirs.update((name, path) for name, path in roots.items() if path is not None)
+    return dirs
+
+
+# Lock files are kept in this directory of the release directory.
+LOCK_DIR = '.locks'
+
+
+def lock_path(release_dir, name):
+    """Return the lock file for `name` (see `util.lock_file`).
+
+    Locks serialise access to shared state between xyz processes using
+    the same release directory: 'source-<pkg_name>' for a package's
+    source, <variant_name> for a variant's build, devtree, install and
+    release, and the filename of a file in the release directory (e.g.:
+    the release index) while it is updated.
+
+    """
+    return os.path.join(release_dir, LOCK_DIR, name + '.lock')
+
+
+def cache_lock(release_dir, kind, key):
+    """Return the lock file for the cache entry <cache_dir>/<kind>/<key>.
+
+    The lock must be held while the entry is created or used, so that
+    it isn't removed by `gc`.
+
+    """
+    return lock_path(release_dir, 'cache-{}-{}'.format(kind, key))
+
+
+def relative_path(path, start):
+    """Return `path` relative to the directory `start`.
+
+    Symlinks are resolved first, as '..' in the result is interpreted
+    from the physical location of `start`.
+
+    """
+    return os.path.relpath(os.path.realpath(path), os.path.realpath(start))
+
+
+# Files (relative to the xyz directory) whose contents are part of
+# every package's build key (see `Package.build_key`).
+XYZ_FILES = ['xyz.py', 'util.py']
+
+
 class UsageError(Exception):
     """This exception is caught 'cleanly' when running as a script.
 
@@ -94,7 +186,7 @@ class Builder:
     functions or class methods.
 
     """
-    def __init__(self, build=None, host=None, jobs=1):
+    def __init__(self, build=None, host=None, jobs=1, store=None, roots=None):
         detected_build = self._detect_build()
         if build is None:
             build = detected_build
@@ -110,10 +202,14 @@ class Builder:
         self.build_platform = build
         self.host = host
         self.packaging_dir = ''
-        self.source_path = os.path.join(self.packaging_dir, 'source')
-        self.build_path = os.path.join(self.packaging_dir, 'build')
+        self.roots = root_dirs(self.packaging_dir, roots)
+        self.source_path = self.roots['source']
+        self.build_path = self.roots['build']
         self.jobs = jobs
+        self.store = store
         self.packages = {}
+        self.source_versions = {}
+        self._build_builder = None
         ensure_dir(self.source_path)
 
     def _detect_build(self):
@@ -127,7 +223,7 @@ class Builder:
 
         if plat == 'darwin' and arch == '64bit':
             build = 'x86_64-apple-darwin'
-        elif plat == 'linux2' and arch == '64bit':
+        elif plat.startswith('linux') and arch == '64bit':
             build = 'x86_64-unknown-linux-gnu'
         # Add other supported platforms as required.
 
@@ -136,20 +232,80 @@ class Builder:
         return build
 
     def _load_pkg(self, pkg_name, variant):
-        """Load the specified variant of a package."""
+        """Load the specified variant of a package.
+
+        Host independent packages are loaded by the builder for the
+        build platform (see `build_builder`).
+
+        """
         pkg_key = (pkg_name, frozenset(variant.items()))
         if not pkg_key in self.packages:
+            rules_class = self._rules_class(pkg_name)
+            if rules_class.host_independent and self.host != self.build_platform:
+                return self.build_builder()._load_pkg(pkg_name, variant)
             if variant:
                 logger.info("Loading package: {} -- {}".format(pkg_name, variant))
             else:
                 logger.info("Loading package: {}".format(pkg_name))
-            module_name = 'rules.{}'.format(pkg_name)
-            __import__(module_name)
-            pkg = sys.modules[module_name].rules(self, variant)
-            self.packages[pkg_key] = pkg
+            self.packages[pkg_key] = rules_class(self, variant)
 
         return self.packages[pkg_key]
 
+    def _rules_class(self, pkg_name):
+        module_name = 'rules.{}'.format(pkg_name)
+        __import__(module_name)
+        return sys.modules[module_name].rules
+
+    def all_variants(self, pkg_name, variant={}):
+        """Return a list of every combination of the variants declared
+        by a package (see `Package.variants`), with the values in
+        `variant` fixed.
+
+        """
+        declared = self._rules_class(pkg_name).variants
+        keys = sorted(key for key in declared if key not in variant)
+        combinations = []
+        for values in itertools.product(*[declared[key] for key in keys]):
+            combination = dict(variant)
+            combination.update((key, val) for key, val in zip(keys, values) if val is not None)
+            combinations.append(combination)
+        return combinations
+
+    def build_builder(self):
+        """Return the builder whose host is the build platform.
+
+        Host independent packages are only built once (for the build
+        platform), whichever host they are needed for.
+
+        """
+        if self.host == self.build_platform:
+            return self
+        if self._build_builder is None:
+            self._build_builder = Builder(self.build_platform, self.build_platform, self.jobs, self.store,
+                                          self.roots)
+            self._build_builder.source_versions = self.source_versions
+        return self._build_builder
+
+    def source_version(self, source_dir, repo_name):
+        """Return the version of the source in `source_dir` (see
+        `util.git_ver`).
+
+        If the source hasn't been downloaded, the version of the head of
+        the repository `repo_name` is used (see `util.git_remote_ver`),
+        which is much cheaper than cloning it.
+
+        Versions are cached, and shared between the builders of a build
+        matrix (see `matrix_builders`).
+
+        """
+        if source_dir not in self.source_versions:
+            if os.path.exists(source_dir):
+                self.source_versions[source_dir] = git_ver(source_dir)
+            else:
+                logger.info("Querying the version of %s", repo_name)
+                self.source_versions[source_dir] = git_remote_ver(repo_name)
+        return self.source_versions[source_dir]
+
     def build(self, pkg_name, reconfigure=False, force=False, force_recursive=False, variant={}):
         """Build a specified package.
 
@@ -158,39 +314,338 @@ class Builder:
 
         """
         pkg = self._load_pkg(pkg_name, variant)
+        self._build_deps(pkg, reconfigure, force_recursive)
+        with self.lock(pkg):
+            usage = self._build_pkg(pkg, reconfigure, force, force_recursive)
+        self._record_usage(pkg, usage, self.jobs)
+
+    def _build_deps(self, pkg, reconfigure, force_recursive):
+        """Ensure a release exists for each dependency of `pkg`,
+        recursively building them as required.
+
+        """
+        for dep_pkg in pkg.dep_pkgs():
+            if self._reuse_release(dep_pkg, force_recursive):
+                continue
+            logger.info("Doing recursive build of '{}'".format(dep_pkg.variant_name))
+            self._build_deps(dep_pkg, reconfigure, force_recursive)
+            with self.lock(dep_pkg):
+                if os.path.exists(dep_pkg.release_file):
+                    logger.info("Reusing '%s' built by another process", dep_pkg.variant_name)
+                    continue
+                usage = self._build_pkg(dep_pkg, reconfigure, force_recursive, force_recursive)
+            self._record_usage(dep_pkg, usage, self.jobs)
+
+    def _reuse_release(self, pkg, force_recursive):
+        """Return True if a release of `pkg` exists, or was fetched from
+        the artifact store.
+
+        If another process is building the package, this waits for it
+        to finish, so its release can be reused.
+
+        """
+        if os.path.exists(pkg.release_file):
+            return True
+        with self.lock(pkg):
+            return os.path.exists(pkg.release_file) or (not force_recursive and self.fetch_release(pkg))
+
+    def lock(self, pkg):
+        """Return a context manager that locks the build, devtree,
+        install and release of package `pkg` against other processes.
+
+        """
+        return lock_file(lock_path(pkg.config['release_dir'], pkg.variant_name))
+
+    def _record_usage(self, pkg, usage, jobs):
+        if usage is None:
+            return
+        usage['jobs'] = jobs
+        release_dir = pkg.config['release_dir']
+        with lock_file(lock_path(release_dir, ResourceHistory.filename)):
+            history = ResourceHistory(release_dir)
+            history.record(pkg.variant_name, usage)
+            history.save()
+
+    def _build_pkg(self, pkg, reconfigure, force, force_recursive):
+        """Build package `pkg`, once the releases of all its
+        dependencies exist. Returns the resource usage of the make
+        phase (see `Package._build`).
+
+        The caller must hold the package's lock.
+
+        """
+        release_dir = pkg.config['release_dir']
+        with lock_file(lock_path(release_dir, LastUse.filename)):
+            last_use = LastUse(release_dir)
+            last_use.touch(pkg.variant_name)
+            last_use.save()
 
         # If forced, remove the various dirs.
         if force:
-            pkg.rmtree('{devtree_dir}')
-            pkg.rmtree('{build_dir}')
-            pkg.rmtree('{install_dir}')
+            pkg.trash_tree('{devtree_dir}')
+            pkg.trash_tree('{build_dir}')
+            pkg.trash_tree('{install_dir}')
+
+        # Install all deps (group releases are composed directly from
+        # their members' releases).
+        pkg._phase = 'deps'
+        if not pkg.group_only:
+            for dep_pkg in pkg.dep_pkgs():
+                pkg.ensure_dir('{devtree_dir}')
+                logger.info("Installing dep: %s", dep_pkg.variant_name)
+                pkg.cmd('tar', 'xf', dep_pkg.release_file, '-C', '{devtree_dir}')
+
+        usage = pkg._build(reconfigure, force, force_recursive, pkg.variant)
+
+        if self.store is not None:
+            try:
+                self.store.put(pkg.build_key, pkg.release_file)
+            except (OSError, urllib.error.URLError) as e:
+                logger.warning("Unable to store %s in %s: %s", pkg.variant_name, self.store, e)
+        return usage
+
+    def build_concurrent(self, targets, reconfigure=False, force=False, force_recursive=False, mem_budget=None):
+        """Build a list of `targets` (loaded packages), and any
+        dependencies without a release, building independent packages
+        concurrently (each in its own process).
+
+        The targets may be loaded by different builders of a build
+        matrix (see `matrix_builders`), in which case the combined
+        dependency graph is built.
+
+        Packages are started (largest recorded CPU time first) while
+        the total of their make -j values is within `self.jobs`, and
+        their estimated memory use is within `mem_budget` bytes (if
+        specified). A package's memory use is estimated as its -j value
+        times the peak RSS recorded for it (see `ResourceHistory`). Its
+        -j value is its share of `self.jobs` (in proportion to recorded
+        CPU time), limited by the remaining memory and the number of
+        jobs it has previously been able to use.
+
+        A package is always started if nothing else is running, even if
+        that exceeds the budget.
 
-        # Install all deps
-        for dep in pkg.full_deps:
-            pkg.ensure_dir('{devtree_dir}')
-            if type(dep) is type(()):
-                dep_name = dep[0]
-                dep_variant = dep[1]
+        """
+        # Variant name -> (pkg, force, variant names of deps being built)
+        nodes = collections.OrderedDict()
+        target_names = set(pkg.variant_name for pkg in targets)
+
+        def visit(pkg, pkg_force):
+            deps = set()
+            for dep_pkg in pkg.dep_pkgs():
+                if dep_pkg.variant_name in nodes or dep_pkg.variant_name in target_names:
+                    deps.add(dep_pkg.variant_name)
+                elif not self._reuse_release(dep_pkg, force_recursive):
+                    visit(dep_pkg, force_recursive)
+                    deps.add(dep_pkg.variant_name)
+            nodes[pkg.variant_name] = (pkg, pkg_force, deps)
+
+        for pkg in targets:
+            if pkg.variant_name not in nodes:
+                visit(pkg, force)
+
+        context = multiprocessing.get_context('fork')
+        pending = list(nodes)
+        done = set()
+        failed = []
+        running = {}
+        free_jobs = self.jobs
+        free_mem = mem_budget
+        while True:
+            history = ResourceHistory(self.roots['release'])
+            ready = [vn for vn in pending if nodes[vn][2] <= done] if not failed else []
+            known = [history.lookup(vn)['cpu'] for vn in ready if history.lookup(vn) is not None]
+            default_weight = sum(known) / len(known) if known else 1.0
+            weights = dict((vn, history.lookup(vn)['cpu'] if history.lookup(vn) is not None else default_weight)
+                           for vn in ready)
+            total_weight = sum(weights.values())
+            for vn in sorted(ready, key=lambda vn: -weights[vn]):
+                entry = history.lookup(vn)
+                job_memory = entry['max_rss'] if entry is not None else DEFAULT_JOB_MEMORY
+                # Every package's share is at least one job, however
+                # small its recorded CPU time.
+                jobs = max(1, int(round(self.jobs * weights[vn] / total_weight))) if total_weight > 0 else 1
+                jobs = min(jobs, free_jobs, useful_jobs(entry) or jobs)
+                mem_jobs = free_mem // max(job_memory, 1) if free_mem is not None else None
+                if mem_jobs is not None:
+                    jobs = min(jobs, mem_jobs)
+                if jobs < 1:
+                    if running:
+                        continue
+                    jobs = 1
+                    if mem_jobs is not None and mem_jobs < 1:
+                        logger.warning("Building %s (-j1) may exceed the memory budget", vn)
+
+                pkg, pkg_force, _ = nodes[vn]
+                logger.info("Starting build of '%s' (-j%d, estimated memory %s)", vn, jobs,
+                            format_size(jobs * job_memory))
+                recv_conn, send_conn = context.Pipe(duplex=False)
+                proc = context.Process(target=self._build_worker,
+                                       args=(pkg, jobs, reconfigure, pkg_force, force_recursive,
+                                             vn not in target_names, send_conn))
+                proc.start()
+                send_conn.close()
+                running[proc.sentinel] = (vn, proc, recv_conn, jobs, jobs * job_memory)
+                pending.remove(vn)
+                free_jobs -= jobs
+                if free_mem is not None:
+                    free_mem -= jobs * job_memory
+
+            if not running:
+                break
+            for sentinel in multiprocessing.connection.wait(list(running)):
+                vn, proc, recv_conn, jobs, memory = running.pop(sentinel)
+                usage = recv_conn.recv() if recv_conn.poll() else None
+                recv_conn.close()
+                proc.join()
+                free_jobs += jobs
+                if free_mem is not None:
+                    free_mem += memory
+                if proc.exitcode != 0:
+                    logger.error("Build of '%s' failed", vn)
+                    failed.append(vn)
+                    continue
+                done.add(vn)
+                self._record_usage(nodes[vn][0], usage, jobs)
+
+        if failed:
+            raise Exception("Failed to build: {}".format(', '.join(failed)))
+        if pending:
+            raise Exception("Unable to build: {}".format(', '.join(pending)))
+
+    def _build_worker(self, pkg, jobs, reconfigure, force, force_recursive, reuse, conn):
+        # Run in a child process by build_concurrent. If `reuse` is
+        # set, a release built by another process (while waiting for
+        # the lock) is reused.
+        pkg.config['jobs'] = '-j{}'.format(jobs)
+        usage = None
+        with self.lock(pkg):
+            if reuse and os.path.exists(pkg.release_file):
+                logger.info("Reusing '%s' built by another process", pkg.variant_name)
             else:
-                dep_name = dep
-                dep_variant = {}
+                usage = self._build_pkg(pkg, reconfigure, force, force_recursive)
+        conn.send(usage)
+        conn.close()
 
-            dep_pkg = self._load_pkg(dep_name, dep_variant)
+    def fetch_release(self, pkg):
+        """Fetch the release of package `pkg` from the artifact store.
 
-            if not os.path.exists(dep_pkg.release_file):
-                logger.info("Doing recursive build of '{}'".format(dep))
-                self.build(dep_name, reconfigure=reconfigure, force=force_recursive,
-                           force_recursive=force_recursive, variant=dep_variant)
+        The release is verified against its embedded listing (and build
+        key) before it is placed in the release directory. Returns True
+        if the release was fetched.
 
-            logger.info("Installing dep: %s", dep_pkg.variant_name)
-            pkg.cmd('tar', 'xf', dep_pkg.release_file, '-C', '{devtree_dir}')
+        """
+        if self.store is None:
+            return False
+        build_key = pkg.build_key
+        release_file = pkg.release_file
+        ensure_dir(os.path.dirname(release_file))
+        tmp = '{}.{}.tmp'.format(release_file, os.getpid())
+        try:
+            try:
+                if not self.store.get(build_key, tmp):
+                    return False
+            except (OSError, urllib.error.URLError) as e:
+                logger.warning("Unable to fetch %s from %s: %s", pkg.variant_name, self.store, e)
+                return False
+            problem = verify_release(tmp, pkg.variant_name, build_key)
+            if problem is not None:
+                logger.warning("Ignoring %s from %s: %s", pkg.variant_name, self.store, problem)
+                return False
+            os.rename(tmp, release_file)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+        logger.info("Fetched %s from %s", pkg.variant_name, self.store)
+        _, files = read_release_listing(release_file, pkg.variant_name)
+        release_dir = pkg.config['release_dir']
+        with lock_file(lock_path(release_dir, ReleaseIndex.filename)):
+            index = ReleaseIndex(release_dir)
+            index.add(pkg, files)
+            index.save()
+        return True
+
+    def plan(self, pkg_name, reconfigure=False, force=False, force_recursive=False, variant={}, planned=None):
+        """Return the plan for building a specified package, without
+        building (or downloading) anything.
+
+        The plan is a list of dictionaries (in build order), one for
+        each package variant that `build` (with the same arguments)
+        would build or reuse. See `Package.plan` for the contents.
+
+        `planned` is a dictionary of plan entries indexed by variant
+        name. It can be passed to successive calls to plan a number of
+        packages, without duplicate entries.
 
-        pkg._build(reconfigure, force, force_recursive, variant)
+        """
+        if planned is None:
+            planned = {}
+        plan = []
+        self._plan(self._load_pkg(pkg_name, variant), 'requested', reconfigure, force, force_recursive,
+                   planned, plan)
+        return plan
+
+    def _plan(self, pkg, reason, reconfigure, force, force_recursive, planned, plan):
+        # This mirrors the decisions made by `build`.
+        for dep_pkg in pkg.dep_pkgs():
+            if dep_pkg.variant_name in planned:
+                continue
+            if os.path.exists(dep_pkg.release_file):
+                entry = dep_pkg.plan(None, reconfigure, force_recursive, planned)
+                planned[dep_pkg.variant_name] = entry
+                plan.append(entry)
+            elif not force_recursive and self._in_store(dep_pkg):
+                entry = dep_pkg.plan(None, reconfigure, force_recursive, planned)
+                entry['action'] = 'fetch'
+                entry['reason'] = 'in artifact store {}'.format(self.store)
+                planned[dep_pkg.variant_name] = entry
+                plan.append(entry)
+            else:
+                reason = 'no release'
+                if self.store is not None and not force_recursive and not dep_pkg._can_compute_build_key():
+                    reason += ' (artifact store not checked: the build key needs the source version)'
+                self._plan(dep_pkg, reason, reconfigure, force_recursive, force_recursive, planned, plan)
+        entry = pkg.plan(reason, reconfigure, force, planned)
+        planned[pkg.variant_name] = entry
+        plan.append(entry)
+
+    def _in_store(self, pkg):
+        # Only check the store if the build key doesn't require a download.
+        if self.store is None or not pkg._can_compute_build_key():
+            return False
+        try:
+            return self.store.contains(pkg.build_key)
+        except (OSError, urllib.error.URLError):
+            return False
 
     def __str__(self):
         return '<Builder: build={} host={} target={}>'.format(self.build, self.host, self.target)
 
 
+def matrix_builders(hosts, build=None, jobs=1, store=None, roots=None):
+    """Return a builder for each of `hosts`.
+
+    The builders share the source versions, and the builder for the
+    build platform (so host independent packages are only built once),
+    so packages loaded by any of the builders can be built together
+    (see `Builder.build_concurrent`).
+
+    """
+    builders = [Builder(build, host, jobs, store, roots) for host in hosts]
+    build_builder = None
+    for b in builders:
+        if b.host == b.build_platform:
+            build_builder = b
+    if build_builder is None:
+        build_builder = builders[0].build_builder()
+    for b in builders:
+        b.source_versions = build_builder.source_versions
+        if b is not build_builder:
+            b._build_builder = build_builder
+    return builders
+
+
 class Package:
     """Base class for rules implementations.
 
@@ -206,9 +661,17 @@ class Package:
     crosstool = False
     pkg_name = None
     group_only = False
+    # Set if the package's output is the same whatever the host (e.g.:
+    # tools that only run on the build platform). Such packages are
+    # always built for the build platform.
+    host_independent = False
     variants = {}
     uses_osx_frameworks = False
     deps = []
+    # Files (relative to the xyz directory) that the rules use, e.g.:
+    # data files and helper scripts. Their contents are part of the
+    # build key, along with `XYZ_FILES`.
+    build_files = []
 
     def __init__(self, builder, variant):
         """Create a new package."""
@@ -224,6 +687,10 @@ class Package:
 
         self.config = self._std_config()
         self.config.update(variant)
+        self._build_key = None
+        self._usage = None
+        # The current build phase, recorded in the command log.
+        self._phase = None
 
     @property
     def full_deps(self):
@@ -232,41 +699,166 @@ class Package:
         else:
             return self.deps
 
+    def dep_pkgs(self):
+        """Return the list of loaded packages for `full_deps`."""
+        dep_pkgs = []
+        for dep in self.full_deps:
+            if type(dep) is type(()):
+                dep_pkgs.append(self.builder._load_pkg(dep[0], dep[1]))
+            else:
+                dep_pkgs.append(self.builder._load_pkg(dep, {}))
+        return dep_pkgs
+
+    def plan(self, reason, reconfigure=False, force=False, planned={}):
+        """Return the plan entry for this package (see `Builder.plan`).
+
+        If `reason` is None, the existing release is reused. Otherwise
+        `reason` is why the package is built.
+
+        The entry is a dictionary containing:
+
+        package: The package name.
+        variant: The package variant.
+        variant_name: The package variant name.
+        deps: Variant names of the package's dependencies.
+        action: 'build', 'reuse' or 'fetch' (from the artifact store).
+        reason: Why the action was chosen.
+        steps: List of [step, reason] pairs, for the steps (fetch,
+          configure, make, install and package) that will be run.
+        level: The length of the longest chain of dependencies that
+          are built before this package (packages with the same level
+          can be built independently).
+        build_key: The package's build key (or None if it can't be
+          determined without querying the source repository). For a
+          reused release this falls back to the key recorded for the
+          release, if any.
+
+        """
+        deps = [dep_pkg.variant_name for dep_pkg in self.dep_pkgs()]
+        entry = {
+            'package': self.pkg_name,
+            'variant': self.variant,
+            'variant_name': self.variant_name,
+            'deps': deps,
+            'build_key': self.build_key if self._can_compute_build_key() else None,
+            'steps': [],
+            'level': 0,
+        }
+        if reason is None:
+            entry['action'] = 'reuse'
+            entry['reason'] = 'release exists'
+            recorded_key = self.recorded_build_key()
+            if entry['build_key'] is None:
+                entry['build_key'] = recorded_key
+            elif recorded_key is not None and recorded_key != entry['build_key']:
+                entry['reason'] = 'release exists (out of date: build key changed)'
+            return entry
+
+        entry['action'] = 'build'
+        entry['reason'] = reason
+        entry['level'] = max([planned[d]['level'] + 1 for d in deps
+                              if d in planned and planned[d]['action'] == 'build'] + [0])
+        steps = entry['steps']
+        if self.group_only:
+            steps.append(['package', 'group of dependencies'])
+            return entry
+        if not self.exists('{source_dir}'):
+            steps.append(['fetch', 'source not downloaded'])
+        if force:
+            steps.append(['configure', 'forced'])
+        elif not self.exists('{build_dir}', '.configured'):
+            steps.append(['configure', 'not configured'])
+        elif reconfigure:
+            steps.append(['configure', 'reconfigure requested'])
+        full = len(steps) > 0 and steps[-1][0] == 'configure'
+        steps.append(['make', 'full build' if full else 'incremental build'])
+        steps.append(['install', 'always reinstalled'])
+        steps.append(['package', 'always repackaged'])
+        return entry
+
+    def recorded_build_key(self):
+        """Return the build key recorded for the package's release, from
+        the release index (or, if not indexed, the release's listing).
+        Returns None if there is no release, or no key was recorded
+        (e.g.: a version 1 listing).
+
+        """
+        entry = ReleaseIndex(self.config['release_dir']).lookup(self.variant_name, self.release_file)
+        if entry is not None:
+            return entry['build_key']
+        if os.path.exists(self.release_file):
+            header, _ = read_release_listing(self.release_file)
+            return header.get('Build Key')
+        return None
+
+    def _can_compute_build_key(self):
+        """Return True if the build key can be determined without
+        querying the source repository of this package (or its
+        dependencies), i.e. the source has been downloaded or its version
+        is already known.
+
+        """
+        if self._build_key is not None:
+            return True
+        source_dir = self.config['source_dir']
+        if not self.group_only and not os.path.exists(source_dir) and source_dir not in self.builder.source_versions:
+            return False
+        return all(dep_pkg._can_compute_build_key() for dep_pkg in self.dep_pkgs())
+
     def ensure_dir(self, *args):
         ensure_dir(self.j(*args))
 
     def rmtree(self, *args):
         rmtree(self.j(*args))
 
+    def trash_tree(self, *args):
+        trash_tree(self.j(*args))
+
     def exists(self, *args):
         return os.path.exists(self.j(*args))
 
     def _build(self, reconfigure, force, force_revursive, variant):
+        """Build the package, once its dependencies are installed in the
+        devtree (group packages are composed directly from the releases
+        of their dependencies).
+
+        Returns a dictionary with the resource usage of the make phase:
+        wall (elapsed seconds), cpu (user and system seconds of all
+        commands) and max_rss (peak RSS in bytes of any one process).
+        Group packages return None.
+
+        """
         if self.group_only:
-            self.ensure_dir('{install_dir}')
-            noprefix_dir = self.j('{install_dir}', 'noprefix')
-            if self.exists(noprefix_dir):
-                if os.path.islink(noprefix_dir):
-                    os.unlink(noprefix_dir)
-                else:
-                    self.rmtree(noprefix_dir)
-            os.symlink(self.j('..', '..', '{devtree_dir}'), noprefix_dir)
-            self._package()
-            return
+            self._phase = 'package'
+            self._package_group()
+            return None
 
         # Download
+        self._phase = 'download'
         self._download()
         # Configure
+        self._phase = 'configure'
         self._configure(reconfigure)
         # Make
-        with chdir(self.config['build_dir']):
-            self.make()
+        self._phase = 'make'
+        start = time.time()
+        self._usage = {'cpu': 0.0, 'max_rss': 0}
+        try:
+            with chdir(self.config['build_dir']):
+                self.make()
+            usage = self._usage
+        finally:
+            self._usage = None
+        usage['wall'] = time.time() - start
         # Install
-        self.rmtree('{install_dir}')
+        self._phase = 'install'
+        self.trash_tree('{install_dir}')
         self.ensure_dir('{install_dir}')
         self.install()
         # Package
+        self._phase = 'package'
         self._package()
+        return usage
 
     def _download(self, force=False):
         """Download the package source from git.
@@ -276,12 +868,27 @@ class Package:
         source directory is removed before re-downloading the source.
 
         """
-        if force:
-            self.rmtree('{source_dir}')
-        if not self.exists('{source_dir}'):
-            cmd = 'git clone {repo_name} {source_dir}'.format(**self.config)
-            logger.info(cmd)
-            os.system(cmd)
+        with lock_file(lock_path(self.config['release_dir'], 'source-' + self.pkg_name)):
+            if force:
+                self.rmtree('{source_dir}')
+            if not self.exists('{source_dir}'):
+                # Clone to a temporary directory, so an interrupted clone
+                # is never mistaken for the source.
+                tmp = '{}.{}.tmp'.format(self.config['source_dir'], os.getpid())
+                rmtree(tmp)
+                # Unlike build commands, git runs in the caller's
+                # environment (PATH, HOME, credentials and proxies).
+                cmd = 'git clone {} {}'.format(self.config['repo_name'], tmp)
+                logger.info(cmd)
+                phase, self._phase = self._phase, 'download'
+                try:
+                    self._run(cmd)
+                except Exception:
+                    rmtree(tmp)
+                    raise Exception("Unable to clone {repo_name}".format(**self.config))
+                finally:
+                    self._phase = phase
+                os.rename(tmp, self.config['source_dir'])
 
         # FIXME: Additional work required here to ensure the correct version
         # is currently checked out in the source directory.
@@ -305,21 +912,54 @@ class Package:
         ensure_dir(self.j('{release_dir}'))
         pkg_root = self.j('{prefix_dir}')
         # Create the package listing file.
-        files = list(file_list(self.j('{prefix_dir}')))
-        pkg_list_fn = self.j('{prefix_dir}', 'share', 'xyz', '{variant_name}')
+        entries = list(listing_entries(pkg_root))
+        pkg_list_fn = self.j('{prefix_dir}', listing_path('{variant_name}'))
         self.ensure_dir(os.path.dirname(pkg_list_fn))
+        fields = []
+        if not self.group_only:
+            fields.append(('Source Version', self.source_version))
+        fields.append(('XYZ Version', xyz_version()))
+        fields.append(('Build Key', self.build_key))
         with open(pkg_list_fn, 'w') as pkg_list_f:
-            pkg_list_f.write('{variant_name}\n'.format(**self.config))
-            if not self.group_only:
-                pkg_list_f.write("Source Version: {}\n".format(git_ver('{source_dir}'.format(**self.config))))
-            pkg_list_f.write("XYZ Version: {}\n".format(git_ver('.')))
-            pkg_list_f.write('\n')
-            for fn in files:
-                pkg_list_f.write('{} {}\n'.format(
-                                 sha256_file(self.j('{prefix_dir}', fn)),
-                                 fn))
+            write_listing(pkg_list_f, self.variant_name, fields, entries)
         logger.info("Creating tar.gz %s/%s -> %s", os.getcwd(), pkg_root, self.config['release_file'])
-        tar_gz('{release_file}'.format(**self.config), pkg_root)
+        # The release is written to a temporary file and renamed in to
+        # place, so other processes never see a partial release.
+        release_file = self.config['release_file']
+        tmp = '{}.{}.tmp'.format(release_file, os.getpid())
+        tar_gz(tmp, pkg_root)
+        os.rename(tmp, release_file)
+
+        release_dir = self.config['release_dir']
+        with lock_file(lock_path(release_dir, ReleaseIndex.filename)):
+            index = ReleaseIndex(release_dir)
+            index.add(self, dict(entries))
+            index.save()
+
+    def _package_group(self):
+        """Create the release of a group package, by composing the
+        releases of its members (see `compose_group`).
+
+        """
+        ensure_dir(self.j('{release_dir}'))
+        fields = [('XYZ Version', xyz_version()), ('Build Key', self.build_key)]
+        release_file = self.config['release_file']
+        logger.info("Composing group %s -> %s", self.variant_name, release_file)
+        tmp = '{}.{}.tmp'.format(release_file, os.getpid())
+        try:
+            files = compose_group(tmp, self.variant_name, fields,
+                                  [(dep_pkg.variant_name, dep_pkg.release_file) for dep_pkg in self.dep_pkgs()],
+                                  ReleaseIndex(self.config['release_dir']))
+            os.rename(tmp, release_file)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+        release_dir = self.config['release_dir']
+        with lock_file(lock_path(release_dir, ReleaseIndex.filename)):
+            index = ReleaseIndex(release_dir)
+            index.add(self, files)
+            index.save()
 
     def host_app_configure(self, *extra_args, env={}):
         args = ('{source_dir_from_build}/configure',
@@ -372,6 +1012,9 @@ class Package:
         _env = {'PATH': '{devtree_dir_abs}/{host}/bin:/usr/bin:/bin:/usr/sbin:/sbin'.format(**self.config),
                 'LANG': 'C'
                 }
+        if self.config['host'] != self.config['build']:
+            # Host independent dependencies are installed for the build platform.
+            _env['PATH'] = '{devtree_dir_abs}/{build}/bin:'.format(**self.config) + _env['PATH']
         _env.update(env)
         for key in _env:
             _env[key] = _env[key].format(**self.config)
@@ -382,9 +1025,103 @@ class Package:
         logger.info('{} ENV={}\n'.format(cmd, _env))
 
         with setenv(_env):
-            r = os.system(cmd)
-            if r != 0:
-                raise Exception("Error: {}".format(r))
+            self._run(cmd)
+
+    def _run(self, cmd):
+        """Run the shell command `cmd` in the current environment,
+        accounting for its resource usage and recording it in the
+        command log.
+
+        """
+        start = time.time()
+        p = subprocess.Popen(cmd, shell=True)
+        io_counts = process_io(p.pid)
+        _, r, rusage = os.wait4(p.pid, 0)
+        p.returncode = r
+        if self._usage is not None:
+            add_rusage(self._usage, rusage)
+        self._log_command(cmd, start, r, rusage, io_counts)
+        if r != 0:
+            raise Exception("Error: {}".format(r))
+
+    def _log_command(self, cmd, start, status, rusage, io_counts):
+        """Append a record of a command run by `cmd` to the command log
+        (see `CommandLog`). `status` is the wait status from `os.wait4`.
+
+        """
+        if io_counts is None:
+            # Fall back to the blocks read and written from storage.
+            io_counts = (rusage.ru_inblock * 512, rusage.ru_oublock * 512)
+        record = {
+            'build': BUILD_ID,
+            'package': self.variant_name,
+            'phase': self._phase,
+            'command': cmd,
+            'start': start,
+            'wall': time.time() - start,
+            'user': rusage.ru_utime,
+            'sys': rusage.ru_stime,
+            'max_rss': rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024,
+            'read_bytes': io_counts[0],
+            'write_bytes': io_counts[1],
+            'status': os.WEXITSTATUS(status) if os.WIFEXITED(status) else None,
+            'signal': os.WTERMSIG(status) if os.WIFSIGNALED(status) else None,
+        }
+        try:
+            CommandLog(self.config['release_dir_abs']).append(record)
+        except OSError as e:
+            logger.warning("Unable to log command: %s", e)
+
+    def pycompile(self, python, *lib_dirs):
+        """Byte compile the Python modules in `lib_dirs` (relative to
+        the install directory) in parallel, with deterministic output
+        (see pycompile.py).
+
+        `python` must be the same version as the Python that will import
+        the byte code.
+
+        """
+        pycompile_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pycompile.py')
+        for lib_dir in lib_dirs:
+            self.cmd(python, pycompile_py, '{jobs}', '--mtime', str(BASE_TIME),
+                     '-d', '/' + lib_dir, self.j('{install_dir_abs}', lib_dir))
+
+    def cached(self, kind, key, create, dest):
+        """Copy the files of the cache entry <cache_dir>/<kind>/<key> in
+        to the directory `dest` (hard linking them where possible).
+
+        If the entry doesn't exist, `create` is first called with the
+        (absolute) path of an empty directory to fill with the entry's
+        files. `key` must identify all the inputs to `create`.
+
+        """
+        entry = os.path.join(self.config['cache_dir_abs'], kind, key)
+        with lock_file(cache_lock(self.config['release_dir_abs'], kind, key)):
+            if os.path.isdir(entry):
+                logger.info("Using cached %s %s", kind, key)
+                # Record the use, for gc.
+                os.utime(entry)
+            else:
+                logger.info("Creating cached %s %s", kind, key)
+                tmp = '{}.{}.tmp'.format(entry, os.getpid())
+                rmtree(tmp)
+                ensure_dir(tmp)
+                try:
+                    create(tmp)
+                except BaseException:
+                    # Including KeyboardInterrupt: a partial entry is
+                    # never left behind.
+                    rmtree(tmp)
+                    raise
+                os.rename(tmp, entry)
+            for name in sorted(os.listdir(entry)):
+                target = os.path.join(dest, name)
+                if os.path.lexists(target):
+                    os.unlink(target)
+                try:
+                    os.link(os.path.join(entry, name), target)
+                except OSError:
+                    shutil.copy2(os.path.join(entry, name), target)
 
     def strip_libiberty(self):
         to_del = [
@@ -420,13 +1157,17 @@ class Package:
 
         root_dir: The root directory for package build process.
         source_dir: Location of package source.
-        source_dir_from_build: Location of package source while in the build directory.
+        source_dir_from_build: Location of package source while in the build directory
+          (relative to the build directory, unless the source root is absolute).
         build_dir: Location of the build directory. This is where e.g.: configure and
           make are run.
         install_dir: Location of the install directory.
         install_dir_abs: Absolute path to the install_dir. (Absolute paths are usually
           required by `make install`.)
         release_dir: Packages ready for release are stored in the release directory.
+        cache_dir: Location of build caches. Each cache entry is a directory,
+          <cache_dir>/<kind>/<key>, that can be removed by `gc` when not locked (see
+          `cache_lock`).
         release_file: The released package's filename.
         repo_name: Repository name.
         jobs: Specifies number of concurrent jobs to run, in the form -jN. Designed
@@ -447,24 +1188,26 @@ class Package:
 
         config['root_dir'] = self.builder.packaging_dir
         config['root_dir_abs'] = os.path.abspath(self.builder.packaging_dir)
-        config['source_dir'] = self.j('{root_dir}', 'source', '{pkg_name}')
-        if os.path.isabs(config['root_dir']):
+        roots = self.builder.roots
+        config['source_dir'] = os.path.join(roots['source'], self.pkg_name)
+        config['build_dir'] = os.path.join(roots['build'], self.variant_name)
+        if os.path.isabs(config['source_dir']):
             config['source_dir_from_build'] = config['source_dir']
         else:
-            # FIXME: This works when the default build_dir is in place, but
-            # may not in other circumstances
-            config['source_dir_from_build'] = self.j('..', '..', '{source_dir}')
+            config['source_dir_from_build'] = relative_path(config['source_dir'], config['build_dir'])
 
-        config['build_dir'] = self.j('{root_dir}', 'build', '{variant_name}')
-        config['devtree_dir'] = self.j('{root_dir}', 'devtree', '{variant_name}')
+        config['devtree_dir'] = os.path.join(roots['devtree'], self.variant_name)
         config['devtree_dir_abs'] = os.path.abspath(config['devtree_dir'])
-        config['install_dir'] = self.j('{root_dir}', 'install', '{variant_name}')
+        config['install_dir'] = os.path.join(roots['install'], self.variant_name)
         config['install_dir_abs'] = os.path.abspath(config['install_dir'])
 
         config['prefix_dir'] = self.j('{install_dir}', config['prefix'][1:])
         config['eprefix_dir'] = self.j('{install_dir}', config['eprefix'][1:])
 
-        config['release_dir'] = self.j('{root_dir}', 'release')
+        config['release_dir'] = roots['release']
+        config['release_dir_abs'] = os.path.abspath(config['release_dir'])
+        config['cache_dir'] = roots['cache']
+        config['cache_dir_abs'] = os.path.abspath(config['cache_dir'])
         config['release_file'] = self.j('{release_dir}', '{variant_name}.tar.gz')
 
         config['repo_name'] = SOURCE_REPO_PREFIX + self.pkg_name
@@ -513,6 +1256,40 @@ class Package:
     def release_file(self):
         return '{release_dir}/{variant_name}.tar.gz'.format(**self.config)
 
+    @property
+    def source_version(self):
+        return self.builder.source_version(self.config['source_dir'], self.config['repo_name'])
+
+    @property
+    def build_key(self):
+        """A hash of all the inputs to building the package.
+
+        The key covers the variant name, the source version, the rules
+        module, the contents of the `XYZ_FILES` and the package's
+        `build_files`, and the build keys of all the package's
+        dependencies. It is always computed from these inputs (the key
+        recorded in an existing release may be out of date), but doesn't
+        require the source to be downloaded (see `Builder.source_version`).
+
+        """
+        if self._build_key is not None:
+            return self._build_key
+
+        h = hashlib.sha256()
+        h.update(self.variant_name.encode())
+        if not self.group_only:
+            h.update(self.source_version.encode())
+        rules_file = getattr(sys.modules[self.__class__.__module__], '__file__', None)
+        if rules_file is not None:
+            h.update(sha256_file(rules_file).encode())
+        xyz_dir = os.path.dirname(os.path.abspath(__file__))
+        for filename in XYZ_FILES + list(self.build_files):
+            h.update('{} {}'.format(filename, sha256_file(os.path.join(xyz_dir, filename))).encode())
+        for dep_pkg in self.dep_pkgs():
+            h.update(dep_pkg.build_key.encode())
+        self._build_key = h.hexdigest()
+        return self._build_key
+
     def prepare(self, builder, config):
         """prepare returns a configuration dictionary containing the appropriate
         set of key-value pairs needed for the configure/make/install/package
@@ -573,52 +1350,1069 @@ class Package:
         return "<{}>".format(self.__class__.__name__)
 
 
-def check_releases():
-    release_dir = 'release'
+def check_releases(release_dir='release'):
+    index = ReleaseIndex(release_dir)
     all_files = {}
-    for f in os.listdir(release_dir):
+    for f in sorted(os.listdir(release_dir)):
+        if not f.endswith('.tar.gz'):
+            continue
         print(f)
-        with tarfile.open(os.path.join(release_dir, f)) as t:
-            for m in t.getmembers():
-                if m.type not in (tarfile.REGTYPE, tarfile.DIRTYPE, tarfile.LNKTYPE, tarfile.SYMTYPE):
-                    raise Exception("{} is the wrong type ({})".format(m.name, m.type))
-
-                e_type = {tarfile.REGTYPE: 'FILE', tarfile.DIRTYPE: 'DIR', tarfile.LNKTYPE: 'LINK', tarfile.SYMTYPE: 'SYMLINK'}[m.type]
-                extra = ''
-                if m.islnk():
-                    extra = '==> ' + m.linkname
-                    d = m.linkname
-                elif m.issym():
-                    extra = '--> ' + m.linkname
-                    d = m.linkname
-                elif m.isfile():
-                    data = t.extractfile(m.name).read()
-                    digest = hashlib.sha256(data).hexdigest()
-                    d = digest
-                    extra = digest
-                elif m.isdir():
-                    d = None
-
-                dupe = ' '
-                info_pack = (e_type, d, m.mtime, m.mode, m.uid, m.gid, m.uname, m.gname)
-                if m.name in all_files:
-                    dupe = 'X'
-                    if all_files[m.name] != info_pack:
-                        print("{} already extracted! {} != {}".format(m.name, all_files[m.name], info_pack))
-                    #assert all_files[m.name] == (e_type, d)
-                all_files[m.name] = info_pack
-                print('\t{} - {:10s} {} {}'.format(dupe, e_type, m.name, extra))
-
-
-def clean():
-    rmtree('install')
-    rmtree('devtree')
-    rmtree('build')
-
-
-def clean_release():
-    clean()
-    rmtree('release')
+        release_file = os.path.join(release_dir, f)
+        entry = index.lookup(release_variant_name(f), release_file)
+        if entry is not None:
+            # The index has an up-to-date listing, so there is no need
+            # to decompress the release.
+            members = []
+            for name, e in sorted(index.files(entry).items()):
+                if e.type == 'l':
+                    members.append((name, 'SYMLINK', e.target, e.mode, '--> ' + e.target))
+                else:
+                    members.append((name, 'FILE', e.hash, e.mode, e.hash))
+        else:
+            members = release_members(release_file)
+
+        for name, e_type, d, mode, extra in members:
+            dupe = ' '
+            info_pack = (e_type, d, mode)
+            if name in all_files:
+                dupe = 'X'
+                if all_files[name] != info_pack:
+                    print("{} already extracted! {} != {}".format(name, all_files[name], info_pack))
+            all_files[name] = info_pack
+            print('\t{} - {:10s} {} {}'.format(dupe, e_type, name, extra))
+
+
+def release_members(release_file):
+    """Return a list of (name, type, data, mode, extra) tuples describing
+    the members of the release tar file `release_file`.
+
+    Releases are created with a standard set of meta-data (see
+    `tar_info_filter`), so only the mode is reported.
+
+    """
+    members = []
+    with tarfile.open(release_file) as t:
+        for m in t.getmembers():
+            if m.type not in (tarfile.REGTYPE, tarfile.DIRTYPE, tarfile.LNKTYPE, tarfile.SYMTYPE):
+                raise Exception("{} is the wrong type ({})".format(m.name, m.type))
+
+            e_type = {tarfile.REGTYPE: 'FILE', tarfile.DIRTYPE: 'DIR', tarfile.LNKTYPE: 'LINK', tarfile.SYMTYPE: 'SYMLINK'}[m.type]
+            extra = ''
+            if m.islnk():
+                extra = '==> ' + m.linkname
+                d = m.linkname
+            elif m.issym():
+                extra = '--> ' + m.linkname
+                d = m.linkname
+            elif m.isfile():
+                data = t.extractfile(m.name).read()
+                digest = hashlib.sha256(data).hexdigest()
+                d = digest
+                extra = digest
+            elif m.isdir():
+                d = None
+            members.append((os.path.normpath(m.name), e_type, d, m.mode, extra))
+    return members
+
+
+def reap_roots(roots):
+    """Remove anything left in the trash of the `roots` (see
+    `util.trash_tree`), in the background. This includes the trash of
+    each kind of cache entry (see `gc`).
+
+    """
+    dirs = set()
+    for root in roots.values():
+        dirs.add(root)
+        dirs.add(os.path.dirname(root) or '.')
+    cache_dir = roots['cache']
+    if os.path.isdir(cache_dir):
+        for kind in os.listdir(cache_dir):
+            if kind != TRASH_DIR and os.path.isdir(os.path.join(cache_dir, kind)):
+                dirs.add(os.path.join(cache_dir, kind))
+    for d in sorted(dirs):
+        reap_trash(d)
+
+
+def clean(roots=None):
+    roots = root_dirs(roots=roots)
+    reap_roots(roots)
+    trash_tree(roots['install'])
+    trash_tree(roots['devtree'])
+    trash_tree(roots['build'])
+
+
+def clean_release(roots=None):
+    clean(roots)
+    trash_tree(root_dirs(roots=roots)['release'])
+
+
+LISTING_VERSION = 2
+
+
+class ListingEntry(collections.namedtuple('ListingEntry', 'type mode size hash target')):
+    """An entry in a package listing.
+
+    `type` is 'f' for a regular file or 'l' for a symbolic link. `mode`
+    is the permission bits, `size` is the file size (or the length of
+    the link target), `hash` is the sha256 of the file contents and
+    `target` is the target of a symbolic link.
+
+    Entries read from a version 1 listing only have a `hash`; all other
+    fields are None.
+
+    """
+    def differs(self, other):
+        """Return True if this entry has different contents to `other`."""
+        if other is None or self.hash != other.hash or self.target != other.target:
+            return True
+        return None not in (self.mode, other.mode) and self.mode != other.mode
+
+    def format(self, filename):
+        lin = '{} {:04o} {} {} {}'.format(self.type, self.mode, self.size, self.hash, filename)
+        if self.type == 'l':
+            lin += ' -> ' + self.target
+        return lin
+
+
+def listing_entry(filename):
+    """Create a ListingEntry describing the file `filename`."""
+    st = os.lstat(filename)
+    mode = stat.S_IMODE(st.st_mode)
+    if stat.S_ISLNK(st.st_mode):
+        target = os.readlink(filename)
+        return ListingEntry('l', mode, len(target), '-', target)
+    return ListingEntry('f', mode, st.st_size, sha256_file(filename), None)
+
+
+def listing_entries(root):
+    """Generate a (filename, ListingEntry) pair for each file (and
+    symbolic link) in the `root` directory tree.
+
+    """
+    if not root.endswith('/'):
+        root += '/'
+    for base, dirs, files in os.walk(root):
+        dirs.sort()
+        names = files + [d for d in dirs if os.path.islink(os.path.join(base, d))]
+        for f in sorted(names):
+            fn = os.path.join(base, f)
+            yield fn[len(root):], listing_entry(fn)
+
+
+def write_listing(f, variant_name, fields, entries):
+    """Write a package listing to the file-like object `f`.
+
+    `fields` is a list of (name, value) header fields, and `entries` is
+    a list of (filename, ListingEntry) pairs.
+
+    """
+    f.write('{}\n'.format(variant_name))
+    f.write('Listing Version: {}\n'.format(LISTING_VERSION))
+    for name, value in fields:
+        f.write('{}: {}\n'.format(name, value))
+    f.write('\n')
+    for filename, entry in entries:
+        f.write(entry.format(filename) + '\n')
+
+
+def read_listing(f):
+    """Parse a package listing from the file-like object `f`.
+
+    A listing consists of a header, terminated by an empty line,
+    followed by one line per file in the package. The first line of
+    the header is the variant name, the remaining lines are `Name:
+    value` fields.
+
+    In a version 1 listing (which has no `Listing Version` field) each
+    file line is `<sha256> <filename>`. In a version 2 listing each
+    file line is `<type> <mode> <size> <sha256> <filename>`, with `->
+    <target>` appended for symbolic links.
+
+    Returns a (header, files) pair, where `header` is a dictionary of
+    the header fields (with the variant name stored as `Variant`) and
+    `files` is a dictionary of ListingEntry objects indexed by
+    filename.
+
+    """
+    header = {}
+    files = {}
+    got_it = False
+    version = 1
+    for lin in f.readlines():
+        if isinstance(lin, bytes):
+            lin = lin.decode()
+        lin = lin.rstrip('\n')
+        if not got_it and len(lin) == 0:
+            got_it = True
+            version = int(header.get('Listing Version', 1))
+        elif got_it and version == 1:
+            filehash, filename = lin.split()
+            files[filename] = ListingEntry(None, None, None, filehash, None)
+        elif got_it:
+            e_type, mode, size, filehash, filename = lin.split(' ', 4)
+            target = None
+            if e_type == 'l':
+                filename, target = filename.split(' -> ', 1)
+            files[filename] = ListingEntry(e_type, int(mode, 8), int(size), filehash, target)
+        elif not header:
+            header['Variant'] = lin
+        else:
+            name, value = lin.split(': ', 1)
+            header[name] = value
+    return header, files
+
+
+def check_entry(filename, entry, quick=False):
+    """Check the file `filename` against its listing `entry`.
+
+    Returns None if the file matches, otherwise a short description of
+    the problem. When `quick` is True the file contents are not hashed.
+
+    """
+    if not os.path.lexists(filename):
+        return 'missing'
+    if entry.type is None:
+        if not quick and sha256_file(filename) != entry.hash:
+            return 'bad hash'
+        return None
+    st = os.lstat(filename)
+    if stat.S_ISLNK(st.st_mode) != (entry.type == 'l'):
+        return 'bad type'
+    if stat.S_IMODE(st.st_mode) != entry.mode and entry.type != 'l':
+        return 'bad mode'
+    if entry.type == 'l':
+        if os.readlink(filename) != entry.target:
+            return 'bad link'
+    elif st.st_size != entry.size:
+        return 'bad size'
+    elif not quick and sha256_file(filename) != entry.hash:
+        return 'bad hash'
+    return None
+
+
+def listing_path(variant_name):
+    """Return the path of a package's listing file relative to the package root."""
+    return os.path.join('share', 'xyz', variant_name)
+
+
+def release_variant_name(release_file):
+    """Return the variant name of the package in `release_file`."""
+    name = os.path.basename(release_file)
+    if name.endswith('.tar.gz'):
+        name = name[:-len('.tar.gz')]
+    return name
+
+
+def read_release_listing(release_file, variant_name=None):
+    """Return the (header, files) listing embedded in the release
+    package `release_file`.
+
+    By default the listing for the variant named by the release
+    filename is read, this can be overridden with `variant_name`.
+
+    """
+    if variant_name is None:
+        variant_name = release_variant_name(release_file)
+    with tarfile.open(release_file) as tf:
+        try:
+            f = tf.extractfile(listing_path(variant_name))
+        except KeyError:
+            raise UsageError("{} has no listing for {}".format(release_file, variant_name))
+        return read_listing(f)
+
+
+def verify_release(release_file, variant_name, build_key=None):
+    """Check the release package `release_file` against its embedded
+    listing (for `variant_name`).
+
+    If `build_key` is specified, the build key in the listing must
+    also match.
+
+    Returns None if the release is intact, otherwise a short
+    description of the problem.
+
+    """
+    try:
+        header, files = read_release_listing(release_file, variant_name)
+    except (UsageError, tarfile.TarError, OSError) as e:
+        return str(e)
+    if build_key is not None and header.get('Build Key') != build_key:
+        return 'build key mismatch'
+    listing = listing_path(variant_name)
+    seen = set()
+    with tarfile.open(release_file) as tf:
+        for m in tf:
+            if m.isdir() or m.name == listing:
+                continue
+            entry = files.get(m.name)
+            if entry is None:
+                return 'unlisted file {}'.format(m.name)
+            seen.add(m.name)
+            if m.issym():
+                if entry.type == 'l' and m.linkname != entry.target:
+                    return 'bad link {}'.format(m.name)
+            else:
+                h = hashlib.sha256()
+                f = tf.extractfile(m)
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+                if h.hexdigest() != entry.hash:
+                    return 'bad hash {}'.format(m.name)
+    missing = set(files) - seen
+    if missing:
+        return 'missing {}'.format(sorted(missing)[0])
+    return None
+
+
+def compose_group(output, variant_name, fields, members, index=None):
+    """Create the release `output` of group package `variant_name`
+    from the releases of its members, without extracting them.
+
+    `members` is a list of (variant_name, release_file) pairs. Each
+    member release is streamed in to the output in turn. A file that
+    is in more than one member is only included once: identical copies
+    (by listing entry) are skipped, and for a conflict (the copies
+    differ) a warning is logged and the last member's copy is used,
+    as if the members had been extracted in order.
+
+    The group listing (with the header `fields`) is composed from the
+    member listings, read from the release `index` when up to date.
+
+    Returns the group's files, as a dictionary of ListingEntry objects
+    indexed by filename.
+
+    """
+    # Choose which member provides each file.
+    files = {}
+    owner = {}
+    for member, release_file in members:
+        entry = index.lookup(member, release_file) if index is not None else None
+        if entry is not None:
+            member_files = index.files(entry)
+        else:
+            _, member_files = read_release_listing(release_file, member)
+        for filename, entry in member_files.items():
+            if filename in files and files[filename] != entry:
+                logger.warning("Group %s: %s differs in %s and %s (using %s)", variant_name, filename,
+                               owner[filename], member, member)
+            if filename not in files or files[filename] != entry:
+                files[filename] = entry
+                owner[filename] = member
+
+    dirs = set()
+    with tarfile.open(output, 'w:gz', format=tarfile.GNU_FORMAT) as out:
+        for member, release_file in members:
+            member_listing = listing_path(member)
+            with tarfile.open(release_file, 'r|gz') as tf:
+                for m in tf:
+                    name = os.path.normpath(m.name)
+                    if m.isdir():
+                        if name not in dirs:
+                            dirs.add(name)
+                            out.addfile(tar_info_filter(m))
+                    elif name == member_listing:
+                        data = tf.extractfile(m).read()
+                        files[name] = ListingEntry('f', m.mode, len(data), hashlib.sha256(data).hexdigest(), None)
+                        out.addfile(tar_info_filter(m), io.BytesIO(data))
+                    elif owner.get(name) == member:
+                        out.addfile(tar_info_filter(m), tf.extractfile(m) if m.isfile() else None)
+
+        listing = io.StringIO()
+        write_listing(listing, variant_name, fields, sorted(files.items()))
+        data = listing.getvalue().encode()
+        info = tarfile.TarInfo(listing_path(variant_name))
+        info.mode = 0o644
+        info.size = len(data)
+        out.addfile(tar_info_filter(info), io.BytesIO(data))
+    return files
+
+
+DELTA_MEMBER = 'XYZ-DELTA'
+
+
+def make_delta(old_release, new_release, output):
+    """Create a delta package `output` that updates an installation of
+    `old_release` to `new_release`.
+
+    Both releases must be of the same variant. The delta contains
+    only the files that were added or changed (based on the hashes
+    in the listings), the new listing, and a `XYZ-DELTA` member. The
+    `XYZ-DELTA` member has the usual listing style header (the variant
+    name, plus the hashes of the base and target listings), followed
+    by the list of files removed by the delta.
+
+    """
+    variant_name = release_variant_name(new_release)
+    old_header, old_files = read_release_listing(old_release, variant_name)
+    new_header, new_files = read_release_listing(new_release, variant_name)
+    if old_header['Variant'] != variant_name or new_header['Variant'] != variant_name:
+        raise UsageError("Can't create delta between {} and {}".format(old_release, new_release))
+
+    changed = set(fn for fn, entry in new_files.items() if entry.differs(old_files.get(fn)))
+    removed = sorted(fn for fn in old_files if fn not in new_files)
+    pkg_list_fn = listing_path(variant_name)
+    changed.add(pkg_list_fn)
+
+    # Parent directories of changed files are included so that they are
+    # created with the correct meta-data.
+    parents = set()
+    for fn in changed:
+        fn = os.path.dirname(fn)
+        while fn:
+            parents.add(fn)
+            fn = os.path.dirname(fn)
+
+    with tarfile.open(new_release) as tf:
+        with tarfile.open(old_release) as old_tf:
+            base_hash = hashlib.sha256(old_tf.extractfile(pkg_list_fn).read()).hexdigest()
+        target_hash = hashlib.sha256(tf.extractfile(pkg_list_fn).read()).hexdigest()
+
+        delta_data = '{}\nBase: {}\nTarget: {}\n\n'.format(variant_name, base_hash, target_hash)
+        delta_data += ''.join('{}\n'.format(fn) for fn in removed)
+        delta_data = delta_data.encode()
+
+        logger.info("Creating delta %s -> %s: %d changed, %d removed",
+                    old_release, new_release, len(changed), len(removed))
+        with tarfile.open(output, 'w:gz', format=tarfile.GNU_FORMAT) as out:
+            info = tar_info_filter(tarfile.TarInfo(DELTA_MEMBER))
+            info.size = len(delta_data)
+            info.mode = 0o644
+            out.addfile(info, io.BytesIO(delta_data))
+            for m in tf.getmembers():
+                name = os.path.normpath(m.name)
+                if m.isdir():
+                    if name in parents:
+                        out.addfile(m)
+                elif name in changed:
+                    out.addfile(m, tf.extractfile(m) if m.isfile() else None)
+
+
+def read_delta(f):
+    """Parse the `XYZ-DELTA` member of a delta package from the
+    file-like object `f`.
+
+    Returns a (variant_name, fields, removed) triple, where `fields` is
+    a dictionary of the header fields and `removed` the list of files
+    removed by the delta.
+
+    """
+    lines = [lin.decode().strip() for lin in f.readlines()]
+    sep = lines.index('')
+    fields = dict(lin.split(': ', 1) for lin in lines[1:sep])
+    return lines[0], fields, [lin for lin in lines[sep + 1:] if lin]
+
+
+class ReleaseIndex:
+    """An index of the releases in a release directory.
+
+    The index is stored as JSON in `index.json` in the release
+    directory. It maps each variant name to a dictionary containing:
+
+    file: The release filename (relative to the release directory).
+    sha256: Hash of the release file.
+    size: Size of the release file.
+    mtime: Modification time of the release file (in nanoseconds).
+    deps: Variant names of the package's dependencies.
+    build_key: The build key of the package.
+    files: The package listing, as a dictionary of [type, mode, size,
+      hash, target] lists indexed by filename.
+
+    This allows questions about releases to be answered without
+    decompressing the release files. The index is updated after each
+    package is created, and is replaced atomically when saved.
+
+    """
+    filename = 'index.json'
+
+    def __init__(self, release_dir):
+        self.release_dir = release_dir
+        self.index_file = os.path.join(release_dir, self.filename)
+        self.releases = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.releases = json.load(f)['releases']
+
+    def save(self):
+        tmp = '{}.{}.tmp'.format(self.index_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'version': 1, 'releases': self.releases}, f, sort_keys=True)
+        os.rename(tmp, self.index_file)
+
+    def add(self, pkg, files):
+        """Add (or replace) the release of package `pkg` in the index.
+
+        `files` is the dictionary of ListingEntry objects in the
+        package's listing.
+
+        """
+        release_file = pkg.release_file
+        st = os.stat(release_file)
+        self.releases[pkg.variant_name] = {
+            'file': os.path.basename(release_file),
+            'sha256': sha256_file(release_file),
+            'size': st.st_size,
+            'mtime': st.st_mtime_ns,
+            'deps': [dep_pkg.variant_name for dep_pkg in pkg.dep_pkgs()],
+            'build_key': pkg.build_key,
+            'files': {fn: list(entry) for fn, entry in files.items()},
+        }
+
+    def lookup(self, variant_name, release_file=None):
+        """Return the index entry for `variant_name` (or None).
+
+        If `release_file` is specified, None is also returned if the
+        entry is out of date with respect to the release file (its size
+        or modification time differ from those recorded).
+
+        """
+        entry = self.releases.get(variant_name)
+        if entry is not None and release_file is not None:
+            try:
+                st = os.stat(release_file)
+            except FileNotFoundError:
+                return None
+            if (st.st_size, st.st_mtime_ns) != (entry['size'], entry.get('mtime')):
+                return None
+        return entry
+
+    def files(self, entry):
+        """Return the listing of an index entry as a dictionary of
+        ListingEntry objects indexed by filename.
+
+        """
+        return {fn: ListingEntry(*e) for fn, e in entry['files'].items()}
+
+    def owners(self, filename):
+        """Return the variant names of the releases containing `filename`."""
+        filename = os.path.normpath(filename)
+        return sorted(variant_name for variant_name, entry in self.releases.items()
+                      if filename in entry['files'])
+
+
+BUILD_KEY_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def add_rusage(usage, rusage):
+    """Add the resource usage of a command (from `os.wait4`) to a usage
+    dictionary (see `Package._build`).
+
+    """
+    usage['cpu'] += rusage.ru_utime + rusage.ru_stime
+    max_rss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+    usage['max_rss'] = max(usage['max_rss'], max_rss)
+
+
+def process_io(pid):
+    """Wait for the child process `pid` to exit, without reaping it,
+    and return a (read, written) pair of the bytes it (and all the
+    children it reaped) read and wrote, from /proc/<pid>/io.
+
+    Returns None if the counts are not available (e.g.: no /proc).
+
+    """
+    try:
+        os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+        with open('/proc/{}/io'.format(pid)) as f:
+            fields = dict(line.split(': ', 1) for line in f.read().splitlines())
+        return int(fields['rchar']), int(fields['wchar'])
+    except (AttributeError, OSError, KeyError, ValueError):
+        return None
+
+
+def useful_jobs(entry):
+    """Return the largest make -j value that a package has been seen to
+    use (from its `ResourceHistory` entry), or None if unknown.
+
+    """
+    if entry is None or entry['wall'] <= 0:
+        return None
+    parallelism = int(math.ceil(entry['cpu'] / entry['wall']))
+    if parallelism >= entry['jobs']:
+        return None
+    return max(1, parallelism)
+
+
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(size):
+    """Return the number of bytes in `size`, e.g.: '512M' or '16G'."""
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+def format_size(size):
+    for suffix in 'TGMK':
+        if size >= SIZE_SUFFIXES[suffix]:
+            return '{:.1f}{}'.format(size / SIZE_SUFFIXES[suffix], suffix)
+    return str(size)
+
+
+class ResourceHistory:
+    """The resource usage recorded for the make phase of each package
+    variant, used to schedule concurrent builds.
+
+    The history is stored as JSON in `usage.json` in the release
+    directory. It maps each variant name to a dictionary containing:
+
+    jobs: The make -j value.
+    wall: Elapsed time (seconds).
+    cpu: User and system time of all make commands (seconds).
+    max_rss: Peak resident set size of any one process (bytes).
+
+    An incremental build uses much less than a full build, so the
+    largest CPU time and peak RSS seen are kept (with the jobs and wall
+    time of the run with the largest CPU time).
+
+    """
+    filename = 'usage.json'
+
+    def __init__(self, release_dir):
+        self.history_file = os.path.join(release_dir, self.filename)
+        self.packages = {}
+        if os.path.exists(self.history_file):
+            with open(self.history_file) as f:
+                self.packages = json.load(f)['packages']
+
+    def save(self):
+        ensure_dir(os.path.dirname(self.history_file) or '.')
+        tmp = '{}.{}.tmp'.format(self.history_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'version': 1, 'packages': self.packages}, f, sort_keys=True)
+        os.rename(tmp, self.history_file)
+
+    def record(self, variant_name, usage):
+        old = self.packages.get(variant_name)
+        entry = dict(usage)
+        if old is not None:
+            if old['cpu'] > entry['cpu']:
+                entry.update(jobs=old['jobs'], wall=old['wall'], cpu=old['cpu'])
+            entry['max_rss'] = max(entry['max_rss'], old['max_rss'])
+        self.packages[variant_name] = entry
+
+    def lookup(self, variant_name):
+        """Return the recorded usage for `variant_name` (or None)."""
+        return self.packages.get(variant_name)
+
+
+class LastUse:
+    """The time each package variant's trees (build, devtree and
+    install) were last used, for `gc`.
+
+    Stored as JSON in `last_use.json` in the release directory, mapping
+    each variant name to a time (in seconds since the epoch).
+
+    """
+    filename = 'last_use.json'
+
+    def __init__(self, release_dir):
+        self.last_use_file = os.path.join(release_dir, self.filename)
+        self.variants = {}
+        if os.path.exists(self.last_use_file):
+            with open(self.last_use_file) as f:
+                self.variants = json.load(f)['variants']
+
+    def save(self):
+        ensure_dir(os.path.dirname(self.last_use_file) or '.')
+        tmp = '{}.{}.tmp'.format(self.last_use_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'version': 1, 'variants': self.variants}, f, sort_keys=True)
+        os.rename(tmp, self.last_use_file)
+
+    def touch(self, variant_name):
+        self.variants[variant_name] = time.time()
+
+    def lookup(self, variant_name):
+        return self.variants.get(variant_name)
+
+
+def gc_candidates(roots):
+    """Return a list of (last_use, name, lock_file, trees) tuples for
+    the trees that `gc` may remove: each variant's build, devtree and
+    install trees, and each cache entry.
+
+    """
+    release_dir = roots['release']
+    last_use = LastUse(release_dir)
+    variants = {}
+    for root in ('build', 'devtree', 'install'):
+        if os.path.isdir(roots[root]):
+            for name in os.listdir(roots[root]):
+                if name != TRASH_DIR:
+                    variants.setdefault(name, []).append(os.path.join(roots[root], name))
+
+    candidates = []
+    for variant_name, trees in variants.items():
+        used = last_use.lookup(variant_name)
+        if used is None:
+            used = max(os.lstat(tree).st_mtime for tree in trees)
+        candidates.append((used, variant_name, lock_path(release_dir, variant_name), trees))
+
+    cache_dir = roots['cache']
+    if os.path.isdir(cache_dir):
+        for kind in os.listdir(cache_dir):
+            kind_dir = os.path.join(cache_dir, kind)
+            if kind == TRASH_DIR or not os.path.isdir(kind_dir):
+                continue
+            for name in os.listdir(kind_dir):
+                if name == TRASH_DIR:
+                    continue
+                # An entry being created is <key>.<pid>.tmp, and has the
+                # entry's lock (see `Package.cached`).
+                key = name.split('.')[0]
+                entry = os.path.join(kind_dir, name)
+                candidates.append((os.lstat(entry).st_mtime, os.path.join(kind, name),
+                                   cache_lock(release_dir, kind, key), [entry]))
+    return sorted(candidates)
+
+
+def gc(roots, budget):
+    """Remove the least recently used trees (see `gc_candidates`) until
+    the total size of the `roots` is within `budget` bytes.
+
+    Sources and releases are counted, but never removed. Trees locked
+    by an active build (or cache entries in use) are skipped. Returns
+    the total size after collection.
+
+    """
+    roots = root_dirs(roots=roots)
+    # A root inside another root (e.g.: --cache-root release/cache) is
+    # already counted in the size of the enclosing root.
+    dirs = set(os.path.abspath(root) for root in roots.values())
+    dirs = [d for d in dirs if not any(d.startswith(os.path.join(other, '')) for other in dirs)]
+    total = sum(tree_size(d) for d in dirs)
+    logger.info("Disk use %s (budget %s)", format_size(total), format_size(budget))
+    for _, name, lock, trees in gc_candidates(roots):
+        if total <= budget:
+            break
+        with lock_file(lock, wait=False) as locked:
+            if not locked:
+                logger.info("Not removing %s (in use)", name)
+                continue
+            size = sum(tree_size(tree) for tree in trees)
+            logger.info("Removing %s (%s)", name, format_size(size))
+            for tree in trees:
+                trash_tree(tree)
+            total -= size
+    if total > budget:
+        logger.warning("Disk use %s is over the budget of %s", format_size(total), format_size(budget))
+    return total
+
+
+class CommandLog:
+    """A log of every command run by `Package.cmd`.
+
+    The log is stored in `commands.jsonl` in the release directory,
+    with one JSON record per line, containing:
+
+    build: Identifies the xyz invocation (see `BUILD_ID`).
+    package: The package variant name.
+    phase: The build phase (download, deps, configure, make, install
+      or package).
+    command: The command line.
+    start: Start time (seconds since the epoch).
+    wall: Elapsed time (seconds).
+    user, sys: User and system CPU time of the command and all its
+      children (seconds).
+    max_rss: Peak resident set size of the largest process (bytes).
+    read_bytes, write_bytes: Bytes read and written by the command
+      and all its children (from /proc/<pid>/io where available,
+      otherwise blocks read and written from storage).
+    status: The exit status (None if the command was killed).
+    signal: The signal that killed the command (or None).
+
+    Records are appended (a line at a time, holding the log's lock), so
+    concurrent builds can share the log. The first time an xyz process
+    appends to the log, it is pruned to make room for the process's
+    build, so the log holds at most `max_builds` builds.
+
+    """
+    filename = 'commands.jsonl'
+    max_builds = 20
+    _pruned = False
+
+    def __init__(self, release_dir):
+        self.release_dir = release_dir
+        self.log_file = os.path.join(release_dir, self.filename)
+
+    def append(self, record):
+        with lock_file(lock_path(self.release_dir, self.filename)):
+            if not CommandLog._pruned:
+                self.prune()
+                CommandLog._pruned = True
+            with open(self.log_file, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def prune(self):
+        """Remove the records of all but the most recent `max_builds` - 1
+        builds. The caller must hold the log's lock.
+
+        """
+        if not os.path.exists(self.log_file):
+            return
+        with open(self.log_file) as f:
+            lines = [line for line in f if line.strip()]
+        starts = {}
+        for line in lines:
+            r = json.loads(line)
+            starts[r['build']] = min(starts.get(r['build'], r['start']), r['start'])
+        if len(starts) < self.max_builds:
+            return
+        keep = set(sorted(starts, key=starts.get)[-(self.max_builds - 1):])
+        tmp = '{}.{}.tmp'.format(self.log_file, os.getpid())
+        with open(tmp, 'w') as f:
+            f.writelines(line for line in lines if json.loads(line)['build'] in keep)
+        os.rename(tmp, self.log_file)
+
+    def records(self, build=None):
+        """Return the records for `build` (by default, the most recent
+        build in the log).
+
+        """
+        if not os.path.exists(self.log_file):
+            return []
+        with open(self.log_file) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        if build is None and records:
+            build = max(records, key=lambda r: r['start'])['build']
+        return [r for r in records if r['build'] == build]
+
+
+def command_report(records):
+    """Return a summary of command log `records` (see `CommandLog`),
+    totalled by phase, by program and by package.
+
+    The summary is a dictionary with the build, and a list of totals
+    for each grouping (largest wall time first). Each total has a name,
+    the count of commands, wall, user and sys times, read_bytes and
+    write_bytes, and the largest max_rss.
+
+    """
+    def program(record):
+        return os.path.basename(record['command'].split()[0]) if record['command'] else ''
+
+    report = {'build': records[0]['build'] if records else None, 'commands': len(records)}
+    for grouping, key in (('phase', lambda r: r['phase'] or ''), ('program', program),
+                          ('package', lambda r: r['package'])):
+        totals = collections.OrderedDict()
+        for r in records:
+            t = totals.setdefault(key(r), {'name': key(r), 'count': 0, 'wall': 0.0, 'user': 0.0, 'sys': 0.0,
+                                           'max_rss': 0, 'read_bytes': 0, 'write_bytes': 0})
+            t['count'] += 1
+            for field in ('wall', 'user', 'sys', 'read_bytes', 'write_bytes'):
+                t[field] += r[field]
+            t['max_rss'] = max(t['max_rss'], r['max_rss'])
+        report[grouping] = sorted(totals.values(), key=lambda t: -t['wall'])
+    return report
+
+
+def format_command_report(report):
+    """Return a command report (see `command_report`) as human readable text."""
+    lines = ['Build {}: {} commands'.format(report['build'], report['commands'])]
+    for grouping in ('phase', 'program', 'package'):
+        lines.append('')
+        lines.append('{:40} {:>5} {:>9} {:>9} {:>9} {:>8} {:>8} {:>8}'.format(
+            'By ' + grouping, 'count', 'wall', 'user', 'sys', 'max rss', 'read', 'written'))
+        for t in report[grouping]:
+            lines.append('{:40} {:5d} {:9.2f} {:9.2f} {:9.2f} {:>8} {:>8} {:>8}'.format(
+                t['name'], t['count'], t['wall'], t['user'], t['sys'], format_size(t['max_rss']),
+                format_size(t['read_bytes']), format_size(t['write_bytes'])))
+    return '\n'.join(lines)
+
+
+class DirectoryStore:
+    """An artifact store in a directory, which may be shared (e.g.: on
+    NFS) between machines.
+
+    Releases are stored as `<build_key>.tar.gz`. Releases are written
+    to a temporary file and renamed in to place, so a partially written
+    release is never visible.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        ensure_dir(path)
+
+    def __str__(self):
+        return self.path
+
+    def _path(self, build_key):
+        if not BUILD_KEY_RE.match(build_key):
+            raise Exception("Invalid build key: {}".format(build_key))
+        return os.path.join(self.path, build_key + '.tar.gz')
+
+    def contains(self, build_key):
+        return os.path.exists(self._path(build_key))
+
+    def get(self, build_key, output):
+        """Copy the release with `build_key` to `output`. Returns False
+        if the store doesn't contain the release.
+
+        """
+        try:
+            with open(self._path(build_key), 'rb') as f, open(output, 'wb') as out:
+                shutil.copyfileobj(f, out)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, build_key, release_file):
+        """Add `release_file` to the store."""
+        with open(release_file, 'rb') as f:
+            self.put_file(build_key, f)
+
+    def put_file(self, build_key, f, size=None):
+        """Add a release, read from the file object `f`, to the store.
+
+        If `size` is specified exactly `size` bytes are read, otherwise
+        `f` is read to the end.
+
+        """
+        dest = self._path(build_key)
+        # The hostname keeps the name unique on a shared filesystem.
+        tmp = '{}.{}.{}.tmp'.format(dest, socket.gethostname(), os.getpid())
+        try:
+            with open(tmp, 'wb') as out:
+                remaining = size
+                while remaining is None or remaining > 0:
+                    data = f.read(1 << 20 if remaining is None else min(1 << 20, remaining))
+                    if not data:
+                        break
+                    out.write(data)
+                    if remaining is not None:
+                        remaining -= len(data)
+            if remaining:
+                raise Exception("Short release upload for {}".format(build_key))
+            os.rename(tmp, dest)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+
+class HTTPStore:
+    """An artifact store accessed over HTTP.
+
+    Releases are fetched with GET and uploaded with PUT to
+    `<url>/<build_key>.tar.gz` (see `serve_store`).
+
+    """
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def __str__(self):
+        return self.url
+
+    def _url(self, build_key):
+        if not BUILD_KEY_RE.match(build_key):
+            raise Exception("Invalid build key: {}".format(build_key))
+        return '{}/{}.tar.gz'.format(self.url, build_key)
+
+    def contains(self, build_key):
+        try:
+            urllib.request.urlopen(urllib.request.Request(self._url(build_key), method='HEAD')).close()
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+        return True
+
+    def get(self, build_key, output):
+        try:
+            resp = urllib.request.urlopen(self._url(build_key))
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+        with resp, open(output, 'wb') as out:
+            shutil.copyfileobj(resp, out)
+        return True
+
+    def put(self, build_key, release_file):
+        with open(release_file, 'rb') as f:
+            req = urllib.request.Request(self._url(build_key), data=f, method='PUT',
+                                         headers={'Content-Length': str(os.path.getsize(release_file)),
+                                                  'Content-Type': 'application/gzip'})
+            urllib.request.urlopen(req).close()
+
+
+def open_store(location):
+    """Return the artifact store for `location` (a URL or directory)."""
+    if location.startswith('http://') or location.startswith('https://'):
+        return HTTPStore(location)
+    return DirectoryStore(location)
+
+
+def serve_store(path, port=8000):
+    """Serve the DirectoryStore at `path` over HTTP (for use with an
+    HTTPStore) until interrupted.
+
+    """
+    import http.server
+    import socketserver
+
+    store = DirectoryStore(path)
+
+    class StoreRequestHandler(http.server.BaseHTTPRequestHandler):
+        def _build_key(self):
+            name = self.path.lstrip('/')
+            if not name.endswith('.tar.gz') or not BUILD_KEY_RE.match(name[:-len('.tar.gz')]):
+                self.send_error(404)
+                return None
+            return name[:-len('.tar.gz')]
+
+        def do_HEAD(self, send_body=False):
+            build_key = self._build_key()
+            if build_key is None:
+                return
+            try:
+                f = open(store._path(build_key), 'rb')
+            except FileNotFoundError:
+                self.send_error(404)
+                return
+            with f:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/gzip')
+                self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+                self.end_headers()
+                if send_body:
+                    shutil.copyfileobj(f, self.wfile)
+
+        def do_GET(self):
+            self.do_HEAD(send_body=True)
+
+        def do_PUT(self):
+            build_key = self._build_key()
+            if build_key is None:
+                return
+            try:
+                size = int(self.headers['Content-Length'])
+            except (TypeError, ValueError):
+                self.send_error(411)
+                return
+            try:
+                store.put_file(build_key, self.rfile, size)
+            except Exception as e:
+                self.send_error(400, str(e))
+                return
+            self.send_response(201)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, fmt, *args):
+            logger.info("%s %s", self.address_string(), fmt % args)
+
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('', port), StoreRequestHandler)
+    logger.info("Serving artifact store %s on port %d", path, server.server_address[1])
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
 
 
 class PkgRoot:
@@ -632,33 +2426,37 @@ class PkgRoot:
         all_files = {}
         for pkg in self.pkgs:
             with open(os.path.join(xyz_dir, pkg)) as f:
-                got_it = False
-                for lin in f.readlines():
-                    lin = lin.strip()
-                    if not got_it and len(lin) == 0:
-                        got_it = True
-                    elif got_it:
-                        filehash, filename = lin.split()
-                        if filename in all_files:
-                            if all_files[filename][0] != filehash:
-                                print("BAD-HASH", filename, pkg, all_files[filename][1])
-                        else:
-                            all_files[filename] = (filehash, [])
-                        all_files[filename][1].append(pkg)
+                _, files = read_listing(f)
+            for filename, entry in files.items():
+                if filename in all_files:
+                    if (all_files[filename][0].hash, all_files[filename][0].target) != (entry.hash, entry.target):
+                        print("BAD-HASH", filename, pkg, all_files[filename][1])
+                else:
+                    all_files[filename] = (entry, [])
+                all_files[filename][1].append(pkg)
 
         self.all_files = all_files
 
-    def verify(self):
+    def verify(self, quick=False):
+        """Verify the installed files against the package listings.
+
+        When `quick` is True only the type, size and mode of each file
+        is checked, avoiding the cost of hashing the file contents. (Files
+        from version 1 listings are not checked in this case.)
+
+        """
         for root, dirs, files in os.walk(self.pkg_root):
             if root == os.path.join(self.pkg_root, 'share'):
                 dirs.remove('xyz')
-            for f in files:
+            for f in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
                 fn = os.path.join(root, f)
                 fn_base = fn[len(self.pkg_root):]
                 if fn_base not in self.all_files:
                     print("warning: no pkg: ", fn_base)
-                elif sha256_file(fn) != self.all_files[fn_base][0]:
-                    print("warning: bad hash:", fn_base)
+                    continue
+                problem = check_entry(fn, self.all_files[fn_base][0], quick)
+                if problem is not None:
+                    print("warning: {}:".format(problem), fn_base)
 
     def update(self, pkg_name, pkg_filename):
         self.remove(pkg_name)
@@ -674,14 +2472,89 @@ class PkgRoot:
         # Ensure it doesn't conflict.
         pass
 
+    def apply_delta(self, delta_filename):
+        """Apply a delta package created by `make_delta`.
+
+        The delta is only applied if the installed listing matches the
+        delta's base listing. Once applied, every file in the target
+        listing is verified against its hash.
+
+        """
+        with tarfile.open(delta_filename) as tf:
+            variant_name, fields, removed = read_delta(tf.extractfile(DELTA_MEMBER))
+            pkg_list_fn = os.path.join(self.pkg_root, listing_path(variant_name))
+            if not os.path.exists(pkg_list_fn) or sha256_file(pkg_list_fn) != fields['Base']:
+                raise UsageError("Delta {} does not apply to installed {}".format(delta_filename, variant_name))
+
+            members = [m for m in tf.getmembers() if m.name != DELTA_MEMBER]
+            links = set(os.path.normpath(m.name) for m in members if m.issym() or m.islnk())
+            gone = set(os.path.normpath(fn) for fn in removed)
+            for name in [m.name for m in members] + removed:
+                if os.path.isabs(name) or '..' in name.split('/'):
+                    raise UsageError("Delta {} contains bad path {}".format(delta_filename, name))
+                # Nothing may be written (or removed) through a symbolic
+                # link, whether already installed (and not removed by
+                # the delta) or added by the delta.
+                parent = os.path.dirname(os.path.normpath(name))
+                while parent:
+                    if parent in links or (parent not in gone and
+                                           os.path.islink(os.path.join(self.pkg_root, parent))):
+                        raise UsageError("Delta {}: {} is below symbolic link {}".format(
+                            delta_filename, name, parent))
+                    parent = os.path.dirname(parent)
+
+            logger.info("Applying delta %s to %s", delta_filename, self.pkg_root)
+            for fn in removed:
+                fn = os.path.join(self.pkg_root, fn)
+                if os.path.lexists(fn):
+                    os.unlink(fn)
+            # Installed symbolic links replaced by the delta are removed
+            # first, so files aren't extracted through them.
+            for m in members:
+                fn = os.path.join(self.pkg_root, m.name)
+                if not m.isdir() and os.path.islink(fn):
+                    os.unlink(fn)
+            tf.extractall(self.pkg_root, members)
+
+        # Remove directories left empty by removed files.
+        dirs = set(os.path.dirname(fn) for fn in removed)
+        for d in sorted(dirs, key=len, reverse=True):
+            while d:
+                path = os.path.join(self.pkg_root, d)
+                if not os.path.isdir(path) or os.path.islink(path) or os.listdir(path):
+                    break
+                os.rmdir(path)
+                d = os.path.dirname(d)
+
+        if sha256_file(pkg_list_fn) != fields['Target']:
+            raise Exception("Delta {}: listing does not match target".format(delta_filename))
+        with open(pkg_list_fn) as f:
+            _, files = read_listing(f)
+        for filename, entry in sorted(files.items()):
+            problem = check_entry(os.path.join(self.pkg_root, filename), entry)
+            if problem is not None:
+                raise Exception("Delta {}: {} for {}".format(delta_filename, problem, filename))
+
 
 def do_list(args):
     pr = PkgRoot(args.pkg_root)
-    pr.verify()
+    pr.verify(args.quick)
     for pkg in pr.pkgs:
         print(pkg)
 
 
+def format_plan(plan):
+    """Return a plan (see `Builder.plan`) as human readable text."""
+    lines = []
+    for entry in plan:
+        lines.append('{:6} {} ({})'.format(entry['action'], entry['variant_name'], entry['reason']))
+        for step, reason in entry['steps']:
+            lines.append('         {:10} {}'.format(step, reason))
+    counts = collections.Counter(entry['action'] for entry in plan)
+    lines.append('{} to build, {} to fetch, {} to reuse'.format(counts['build'], counts['fetch'], counts['reuse']))
+    return '\n'.join(lines)
+
+
 def main(args):
     """main entry point. args is a list of arguments, generally provided directly
     from sys.argv
@@ -694,12 +2567,16 @@ def main(args):
     parser = argparse.ArgumentParser(description='XYZ package builder.')
     parser.add_argument('--pkg-root', help='Root of package install directory.')
     parser.add_argument('--build', help='Explicitly set the build system. (default: autodetect)')
-    parser.add_argument('--host', help='Explicitly set the host system. (default: build)')
+    parser.add_argument('--host', help='Comma separated list of host systems to build for. (default: build)')
     parser.add_argument('--reconfigure', help='Reconfigure. (default: False)', action='store_true', default=False)
     parser.add_argument('--force', help='Force a build. (default: False)', action='store_true', default=False)
     parser.add_argument('--force-recursive', help='Force a build, and alls deps (default: False)', action='store_true', default=False)
     parser.add_argument('-j', dest='jobs', help='Simultaneous jobs. (default: 1)', type=int, default=1)
-    parser.add_argument('--config', help='Comma separated list of config options')
+    parser.add_argument('--mem-budget', metavar='SIZE', type=parse_size,
+                        help='Build packages concurrently, within the -j jobs and an estimated SIZE '
+                        'bytes of memory (e.g.: 16G).')
+    parser.add_argument('--config', action='append',
+                        help='Comma separated list of config options. May be repeated to build several variants.')
     parser.add_argument('--check-releases', action='store_true', default=False,
                         help='Check that the release files are consistent.')
     parser.add_argument('--clean', action='store_true', default=False,
@@ -708,16 +2585,76 @@ def main(args):
                         help='Clean, including release directory.')
     parser.add_argument('--list', action='store_true', default=False,
                         help='List installed packages.')
+    parser.add_argument('--quick', action='store_true', default=False,
+                        help='With --list, only check the type, size and mode of installed files.')
+    parser.add_argument('--make-delta', nargs=3, metavar=('OLD', 'NEW', 'DELTA'),
+                        help='Create a delta package that updates release OLD to release NEW.')
+    parser.add_argument('--apply-delta', metavar='DELTA',
+                        help='Apply a delta package to the package root.')
+    parser.add_argument('--owner', metavar='PATH',
+                        help='List the releases containing PATH (from the release index).')
+    parser.add_argument('--store', metavar='DIR|URL',
+                        help='Artifact store used to fetch and store releases (a directory or http URL).')
+    parser.add_argument('--serve-store', metavar='DIR',
+                        help='Serve the artifact store in DIR over HTTP.')
+    parser.add_argument('--port', type=int, default=8000, help='Port for --serve-store. (default: 8000)')
+    for name in ROOTS:
+        parser.add_argument('--{}-root'.format(name), metavar='DIR',
+                            help='Directory for the {} trees. (default: ./{})'.format(name, name))
+    parser.add_argument('--all-variants', action='store_true', default=False,
+                        help='Build every combination of the variants declared by each package '
+                        '(other than those set by --config).')
+    parser.add_argument('--gc', action='store_true', default=False,
+                        help='Remove the least recently used build, devtree, install and cache trees '
+                        'to bring disk use within --disk-budget.')
+    parser.add_argument('--disk-budget', metavar='SIZE', type=parse_size,
+                        help='Disk budget for --gc. If specified when building, gc is run after the build.')
+    parser.add_argument('--report', action='store_true', default=False,
+                        help='Summarise the time and resources used by the commands of the most recent build.')
+    parser.add_argument('--plan', action='store_true', default=False,
+                        help='Show what would be built (and why), without building.')
+    parser.add_argument('--json', action='store_true', default=False,
+                        help='With --plan or --report, output JSON.')
     parser.add_argument('packages', metavar='PKG', nargs='*', help='list of packages to build')
 
     args = parser.parse_args(args[1:])
+    roots = dict((name, getattr(args, '{}_root'.format(name))) for name in ROOTS)
 
     if args.clean:
-        clean()
+        clean(roots)
         return 0
 
     if args.clean_release:
-        clean_release()
+        clean_release(roots)
+        return 0
+
+    if args.make_delta:
+        make_delta(*args.make_delta)
+        return 0
+
+    if args.report:
+        report = command_report(CommandLog(root_dirs(roots=roots)['release']).records())
+        if args.json:
+            print(json.dumps(report, indent=4, sort_keys=True))
+        else:
+            print(format_command_report(report))
+        return 0
+
+    if args.gc:
+        if args.disk_budget is None:
+            parser.error("--disk-budget must be specified when using --gc")
+        gc(roots, args.disk_budget)
+        return 0
+
+    if args.apply_delta:
+        if args.pkg_root is None:
+            parser.error("--pkg-root must be specified when using --apply-delta")
+        PkgRoot(args.pkg_root).apply_delta(args.apply_delta)
+        return 0
+
+    if args.owner:
+        for variant_name in ReleaseIndex(root_dirs(roots=roots)['release']).owners(args.owner):
+            print(variant_name)
         return 0
 
     if args.list:
@@ -730,16 +2667,49 @@ def main(args):
         args.force = True
 
     if args.config:
-        config = dict([tuple(x.split(':')) for x in args.config.split(',')])
+        configs = [dict([tuple(x.split(':')) for x in c.split(',')]) for c in args.config]
+    else:
+        configs = [{}]
+    hosts = args.host.split(',') if args.host else [None]
+
+    if args.serve_store:
+        serve_store(args.serve_store, args.port)
+        return 0
+
+    store = open_store(args.store) if args.store else None
+    builders = matrix_builders(hosts, args.build, args.jobs, store, roots)
+    # The build matrix: each package, for each host and variant.
+    matrix = []
+    for b in builders:
+        for config in configs:
+            for pkg in args.packages:
+                variants = b.all_variants(pkg, config) if args.all_variants else [config]
+                matrix += [(b, pkg, variant) for variant in variants]
+    if args.plan:
+        planned = {}
+        plan = []
+        for b, pkg, config in matrix:
+            plan += b.plan(pkg, args.reconfigure, args.force, args.force_recursive, variant=config,
+                           planned=planned)
+        if args.json:
+            print(json.dumps({'packages': plan}, indent=4, sort_keys=True))
+        else:
+            print(format_plan(plan))
+        return 0
+
+    reap_roots(root_dirs(roots=roots))
+    if args.mem_budget is not None or len(matrix) > len(args.packages):
+        targets = [b._load_pkg(pkg, config) for b, pkg, config in matrix]
+        builders[0].build_concurrent(targets, args.reconfigure, args.force, args.force_recursive, args.mem_budget)
     else:
-        config = {}
+        for b, pkg, config in matrix:
+            b.build(pkg, args.reconfigure, args.force, args.force_recursive, variant=config)
 
-    b = Builder(args.build, args.host, args.jobs)
-    for pkg in args.packages:
-        b.build(pkg, args.reconfigure, args.force, args.force_recursive, variant=config)
+    if args.disk_budget is not None:
+        gc(roots, args.disk_budget)
 
     if args.check_releases:
-        check_releases()
+        check_releases(builders[0].roots['release'])
         return 0
 
     return 0